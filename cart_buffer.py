@@ -0,0 +1,203 @@
+import logging
+import threading
+
+import requests
+
+from cart_mirror import cart_mirror
+from metrics import registry
+from shop_api import add_item_to_cart, update_item_to_cart, get_cart_items, get_mirrored_cart_items
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WINDOW = 1.0
+DEFAULT_MAX_ATTEMPTS = 4
+
+MUTATIONS = registry.counter('cart_mutations_total', 'Изменения корзин через буфер', ['result'])
+
+
+class CartBuffer:
+    # Нажатия «Добавить в корзину» копятся за окно и записываются одним запросом
+
+    def __init__(self, window=DEFAULT_WINDOW, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.window = window
+        self.max_attempts = max_attempts
+        self._get_access_token = None
+        self._on_failure = None
+        self._pending = {}
+        self._unconfirmed = {}
+        self._timers = {}
+        self._flush_locks = {}
+        self._lock = threading.Lock()
+
+    def _schedule(self, cart_id, delay):
+        # Вызывается под self._lock
+        if cart_id not in self._timers:
+            timer = threading.Timer(delay, self._flush_later, (cart_id,))
+            timer.daemon = True
+            self._timers[cart_id] = timer
+            timer.start()
+
+    def _get_flush_lock(self, cart_id):
+        with self._lock:
+            return self._flush_locks.setdefault(str(cart_id), threading.Lock())
+
+    def add(self, cart_id, product_id, amount=1):
+        cart_id = str(cart_id)
+        with self._lock:
+            deltas = self._pending.setdefault(cart_id, {})
+            deltas[product_id] = deltas.get(product_id, 0) + amount
+            self._schedule(cart_id, self.window)
+
+        MUTATIONS.inc(result='buffered')
+
+    def get_pending(self, cart_id):
+        cart_id = str(cart_id)
+        with self._lock:
+            pending = dict(self._pending.get(cart_id, {}))
+            for product_id, (amount, _, _) in self._unconfirmed.get(cart_id, {}).items():
+                pending[product_id] = pending.get(product_id, 0) + amount
+
+        return pending
+
+    def count_positions(self, cart_id, items):
+        product_ids = {item['product_id'] for item in items}
+        product_ids.update(product_id for product_id, amount in self.get_pending(cart_id).items() if amount > 0)
+
+        return len(product_ids)
+
+    def _confirm(self, access_token, cart_id, unconfirmed):
+        # Ответ мог потеряться: повторяем только то, чего нет в корзине
+        items = get_cart_items(access_token, cart_id)
+        retries = {}
+        for product_id, (amount, expected, attempts) in unconfirmed.items():
+            item = next((item for item in items if item['product_id'] == product_id), None)
+            if expected is not None and item is not None and item['quantity'] >= expected:
+                MUTATIONS.inc(result='written')
+            else:
+                retries[product_id] = (amount, attempts)
+
+        return retries
+
+    def _write(self, access_token, cart_id, product_id, amount):
+        # Возвращает (ожидаемое количество или None, ошибка)
+        try:
+            items = get_mirrored_cart_items(access_token, cart_id)
+        except requests.exceptions.RequestException as err:
+            return None, str(err)
+
+        item = next((item for item in items if item['product_id'] == product_id), None)
+        expected = (item['quantity'] if item else 0) + amount
+        try:
+            if item:
+                cart_items = update_item_to_cart(access_token, cart_id, product_id, item, amount)
+            else:
+                cart_items = add_item_to_cart(access_token, cart_id, product_id, amount)
+        except requests.exceptions.RequestException as err:
+            cart_mirror.forget(cart_id)
+            return expected, str(err)
+
+        return expected, cart_items.get('errors')
+
+    def flush(self, cart_id, access_token=None):
+        cart_id = str(cart_id)
+        with self._get_flush_lock(cart_id):
+            with self._lock:
+                deltas = self._pending.pop(cart_id, {})
+                unconfirmed = self._unconfirmed.pop(cart_id, {})
+                timer = self._timers.pop(cart_id, None)
+            if timer is not None:
+                timer.cancel()
+            if not deltas and not unconfirmed:
+                return
+
+            access_token = access_token or self._get_access_token()
+            writes = {product_id: (amount, 0) for product_id, amount in deltas.items() if amount > 0}
+            if unconfirmed:
+                try:
+                    retries = self._confirm(access_token, cart_id, unconfirmed)
+                except requests.exceptions.RequestException as err:
+                    failed = {}
+                    for product_id, (amount, expected, attempts) in unconfirmed.items():
+                        self._fail(cart_id, product_id, amount, expected, attempts, f'сверка: {err}', failed)
+                    self._requeue(cart_id, failed, deltas)
+                    return
+                for product_id, (amount, attempts) in retries.items():
+                    pending_amount, _ = writes.get(product_id, (0, 0))
+                    writes[product_id] = (amount + pending_amount, attempts)
+
+            failed = {}
+            for product_id, (amount, attempts) in writes.items():
+                expected, error = self._write(access_token, cart_id, product_id, amount)
+                if error is None:
+                    MUTATIONS.inc(result='written')
+                else:
+                    self._fail(cart_id, product_id, amount, expected, attempts, error, failed)
+
+            self._requeue(cart_id, failed)
+
+    def _fail(self, cart_id, product_id, amount, expected, attempts, error, failed):
+        attempts += 1
+        if attempts >= self.max_attempts:
+            logger.error(f'Не удалось добавить {product_id} x{amount} в корзину {cart_id}: {error}')
+            MUTATIONS.inc(result='failed')
+            if self._on_failure is not None:
+                self._on_failure(cart_id, product_id, amount)
+        else:
+            logger.warning(f'Не удалось добавить {product_id} x{amount} в корзину {cart_id}, повтор: {error}')
+            MUTATIONS.inc(result='retried')
+            failed[product_id] = (amount, expected, attempts)
+
+    def _requeue(self, cart_id, unconfirmed, deltas=None):
+        with self._lock:
+            for product_id, amount in (deltas or {}).items():
+                pending = self._pending.setdefault(cart_id, {})
+                pending[product_id] = pending.get(product_id, 0) + amount
+            if unconfirmed:
+                self._unconfirmed.setdefault(cart_id, {}).update(unconfirmed)
+            if cart_id in self._pending or cart_id in self._unconfirmed:
+                attempts = max((attempts for _, _, attempts in unconfirmed.values()), default=0)
+                self._schedule(cart_id, self.window * 2 ** attempts)
+
+    def _flush_later(self, cart_id):
+        try:
+            self.flush(cart_id)
+        except Exception as err:
+            logger.error(f'Не удалось записать корзину {cart_id}: {err}')
+
+    def reconcile(self, access_token):
+        # Сверка не должна вклиниться между записями корзины
+        for cart_id in cart_mirror.stale_carts():
+            with self._get_flush_lock(cart_id):
+                if not self.get_pending(cart_id):
+                    get_cart_items(access_token, cart_id)
+
+    def start(self, get_access_token, on_failure=None):
+        self._get_access_token = get_access_token
+        self._on_failure = on_failure
+
+        return self
+
+    def drain(self):
+        # Записывает накопленное и дожидается записей, уже начатых по таймеру
+        with self._lock:
+            cart_ids = set(self._pending) | set(self._unconfirmed)
+            flush_locks = list(self._flush_locks.values())
+        for cart_id in cart_ids:
+            self._flush_later(cart_id)
+        for flush_lock in flush_locks:
+            with flush_lock:
+                pass
+
+    def stop(self):
+        self.drain()
+
+
+cart_buffer = CartBuffer()
+
+
+def configure_cart_buffer(window=DEFAULT_WINDOW, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    cart_buffer.window = window
+    cart_buffer.max_attempts = max_attempts
+
+    return cart_buffer
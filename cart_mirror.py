@@ -0,0 +1,60 @@
+import time
+import threading
+
+
+DEFAULT_MAX_AGE = 300
+DEFAULT_IDLE_TIMEOUT = 3600
+
+
+class CartMirror:
+    # Локальная копия позиций корзин из ответов Moltin
+
+    def __init__(self, max_age=DEFAULT_MAX_AGE, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.max_age = max_age
+        self.idle_timeout = idle_timeout
+        self._carts = {}
+        self._lock = threading.Lock()
+
+    def replace(self, cart_id, items):
+        now = time.monotonic()
+        with self._lock:
+            self._carts[str(cart_id)] = {
+                'items': list(items),
+                'synced_at': now,
+                'accessed_at': now,
+            }
+
+    def forget(self, cart_id):
+        with self._lock:
+            self._carts.pop(str(cart_id), None)
+
+    def get_items(self, cart_id):
+        with self._lock:
+            cart = self._carts.get(str(cart_id))
+            if cart is None:
+                return None
+            cart['accessed_at'] = time.monotonic()
+
+            return list(cart['items'])
+
+    def find_item(self, cart_id, product_id):
+        items = self.get_items(cart_id)
+        if items is None:
+            return None
+
+        return next((item for item in items if item['product_id'] == product_id), None)
+
+    def stale_carts(self):
+        now = time.monotonic()
+        stale = []
+        with self._lock:
+            for cart_id, cart in list(self._carts.items()):
+                if now - cart['accessed_at'] > self.idle_timeout:
+                    del self._carts[cart_id]
+                elif now - cart['synced_at'] > self.max_age:
+                    stale.append(cart_id)
+
+        return stale
+
+
+cart_mirror = CartMirror()
@@ -0,0 +1,106 @@
+import os
+import time
+import logging
+import threading
+
+from shop_api import iter_products, get_product_by_id
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CATALOG_TTL = 300
+# loaddata.py сбрасывает кэш бота через отметку в файле
+CATALOG_STAMP = 'catalog.stamp'
+
+
+class CatalogCache:
+
+    def __init__(self, ttl=DEFAULT_CATALOG_TTL, stamp_path=CATALOG_STAMP):
+        self.ttl = ttl
+        self.stamp_path = stamp_path
+        self._snapshot = None
+        self._expires_at = 0
+        self._stamp = None
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        return self._snapshot[0] if self._snapshot else 0
+
+    def _read_stamp(self):
+        try:
+            return os.stat(self.stamp_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _is_fresh(self):
+        return (
+            self._snapshot is not None
+            and time.monotonic() < self._expires_at
+            and self._read_stamp() == self._stamp
+        )
+
+    def _refresh(self, access_token):
+        with self._lock:
+            # Пока ждали блокировку, каталог мог обновить другой поток
+            if self._is_fresh():
+                return
+
+            stamp = self._read_stamp()
+            try:
+                products = list(iter_products(access_token, prefetch=True))
+            except Exception as err:
+                if self._snapshot is None:
+                    raise
+                logger.warning(f'Не удалось обновить каталог, используется прежняя версия: {err}')
+                self._expires_at = time.monotonic() + self.ttl
+                return
+
+            index = {product['id']: product for product in products}
+            self._snapshot = (self.version + 1, products, index)
+            self._stamp = stamp
+            self._expires_at = time.monotonic() + self.ttl
+
+    def get_versioned_products(self, access_token):
+        # Версия и список берутся из одного снимка
+        if not self._is_fresh():
+            self._refresh(access_token)
+
+        version, products, _ = self._snapshot
+        return version, products
+
+    def get_products(self, access_token):
+        _, products = self.get_versioned_products(access_token)
+        return products
+
+    def get_product(self, access_token, product_id):
+        if not self._is_fresh():
+            self._refresh(access_token)
+
+        _, _, index = self._snapshot
+        product = index.get(product_id)
+        if product is None:
+            product = get_product_by_id(access_token, product_id)
+
+        return product
+
+    def invalidate(self):
+        with self._lock:
+            self._expires_at = 0
+
+
+catalog = CatalogCache()
+
+
+def configure_catalog(ttl=DEFAULT_CATALOG_TTL, stamp_path=CATALOG_STAMP):
+    catalog.ttl = ttl
+    catalog.stamp_path = stamp_path
+    catalog.invalidate()
+
+    return catalog
+
+
+def invalidate_catalog(stamp_path=CATALOG_STAMP):
+    with open(stamp_path, 'a'):
+        os.utime(stamp_path)
+    catalog.invalidate()
@@ -0,0 +1,105 @@
+import time
+import queue
+import logging
+import threading
+from collections import deque
+
+from metrics import registry
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 8
+DEFAULT_MAX_PENDING = 1000
+
+PENDING = registry.gauge('bot_updates_pending', 'Обновления, ожидающие обработки или обрабатываемые')
+WAIT_SECONDS = registry.histogram('bot_update_wait_seconds', 'Ожидание обновления в очереди своего чата')
+
+
+class ChatDispatcher:
+    # Обновления одного чата идут по очереди, разных чатов - параллельно
+
+    def __init__(self, workers=DEFAULT_WORKERS, max_pending=DEFAULT_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._chats = {}
+        self._ready = queue.Queue()
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._threads = []
+
+    def submit(self, chat_id, handler, *args):
+        if not self._threads:
+            handler(*args)
+            return
+
+        # При переполнении вызывающий поток ждёт
+        with self._changed:
+            while self._pending >= self.max_pending:
+                self._changed.wait()
+            self._pending += 1
+            PENDING.set(self._pending)
+
+            task = (handler, args, time.monotonic())
+            tasks = self._chats.get(chat_id)
+            if tasks is None:
+                self._chats[chat_id] = deque([task])
+                self._ready.put(chat_id)
+            else:
+                tasks.append(task)
+
+    def _work(self):
+        while True:
+            chat_id = self._ready.get()
+            if chat_id is None:
+                return
+
+            with self._lock:
+                handler, args, submitted_at = self._chats[chat_id].popleft()
+            WAIT_SECONDS.observe(time.monotonic() - submitted_at)
+
+            try:
+                handler(*args)
+            except Exception as err:
+                logger.exception(f'Ошибка обработки обновления чата {chat_id}: {err}')
+
+            # Пока обновление выполняется, новые обновления чата ждут его
+            with self._changed:
+                self._pending -= 1
+                PENDING.set(self._pending)
+                if self._chats[chat_id]:
+                    self._ready.put(chat_id)
+                else:
+                    del self._chats[chat_id]
+                self._changed.notify_all()
+
+    def start(self):
+        if not self._threads:
+            for number in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f'chat-worker-{number}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+        return self
+
+    def stop(self):
+        with self._changed:
+            while self._pending:
+                self._changed.wait()
+
+        for _ in self._threads:
+            self._ready.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+chat_dispatcher = ChatDispatcher()
+
+
+def configure_chat_dispatcher(workers=DEFAULT_WORKERS, max_pending=DEFAULT_MAX_PENDING):
+    chat_dispatcher.workers = workers
+    chat_dispatcher.max_pending = max_pending
+
+    return chat_dispatcher
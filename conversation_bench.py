@@ -0,0 +1,265 @@
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+from pathlib import Path
+from itertools import count
+from types import SimpleNamespace
+
+import shop_api
+import pizza_bot
+from catalog import catalog, configure_catalog
+from moltin_stub import MoltinStub, EXAMPLE_DIR
+from photo_cache import configure_photo_cache
+from image_store import configure_image_store
+from pizzeria_directory import PizzeriaDirectory
+from delivery_zones import DeliveryZones
+from state_store import configure_state_store
+from token_manager import TokenManager
+from customer_sync import configure_customer_sync
+from cart_buffer import cart_buffer, configure_cart_buffer
+from durable_jobs import durable_jobs, configure_durable_jobs
+from webhook_bench import percentile
+
+
+message_ids = count(1)
+
+
+class FakeMessage:
+
+    def __init__(self, bot, chat_id, text=None, location=None, photo=None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = next(message_ids)
+        self.text = text
+        self.location = location
+        self.photo = photo
+
+    def reply_text(self, text, reply_markup=None, **kwargs):
+        return self.bot.send_message(chat_id=self.chat_id, text=text, reply_markup=reply_markup)
+
+
+class FakeCallbackQuery:
+
+    def __init__(self, bot, chat_id, data):
+        self.bot = bot
+        self.id = str(next(message_ids))
+        self.data = data
+        self.message = FakeMessage(bot, chat_id)
+
+    def answer(self, *args, **kwargs):
+        self.bot.count('answer_callback_query')
+
+    def edit_message_reply_markup(self, reply_markup=None, **kwargs):
+        self.bot.count('edit_message_reply_markup')
+
+    def edit_message_text(self, text, reply_markup=None, **kwargs):
+        self.bot.count('edit_message_text')
+
+
+class FakeBot:
+    # Вместо Telegram: только считает вызовы и возвращает правдоподобные сообщения
+
+    def __init__(self):
+        self.calls = {}
+
+    def count(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+    def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        self.count('send_message')
+        return FakeMessage(self, chat_id, text=text)
+
+    def send_photo(self, chat_id, photo, caption=None, reply_markup=None, **kwargs):
+        self.count('send_photo')
+        if hasattr(photo, 'read'):
+            photo.read()
+            photo = f'file-{next(message_ids)}'
+        return FakeMessage(self, chat_id, text=caption, photo=[SimpleNamespace(file_id=photo)])
+
+    def send_location(self, chat_id, latitude, longitude, **kwargs):
+        self.count('send_location')
+        return FakeMessage(self, chat_id)
+
+    def delete_message(self, chat_id, message_id, **kwargs):
+        self.count('delete_message')
+        return True
+
+    def send_invoice(self, chat_id, *args, **kwargs):
+        self.count('send_invoice')
+        return FakeMessage(self, chat_id)
+
+
+class FakeJobQueue:
+
+    def __init__(self):
+        self.jobs = []
+
+    def run_once(self, callback, when, context=None, **kwargs):
+        self.jobs.append((callback, when, context))
+
+
+def message_update(bot, chat_id, text=None, location=None):
+    return SimpleNamespace(
+        message=FakeMessage(bot, chat_id, text=text, location=location),
+        callback_query=None,
+    )
+
+
+def callback_update(bot, chat_id, data):
+    return SimpleNamespace(message=None, callback_query=FakeCallbackQuery(bot, chat_id, data))
+
+
+def build_scenario(bot, chat_id, product_id, location):
+    return [
+        lambda: message_update(bot, chat_id, text='/start'),
+        lambda: callback_update(bot, chat_id, product_id),
+        lambda: callback_update(bot, chat_id, product_id),
+        lambda: callback_update(bot, chat_id, 'Корзина'),
+        lambda: callback_update(bot, chat_id, 'Оформить'),
+        lambda: message_update(bot, chat_id, text=f'user{chat_id}@example.com'),
+        lambda: message_update(bot, chat_id, location={'latitude': location[0], 'longitude': location[1]}),
+        lambda: callback_update(bot, chat_id, 'Доставка'),
+        lambda: callback_update(bot, chat_id, 'Наличные'),
+    ]
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='''
+        Прогон диалога START -> ... -> START_PAYMENT через handle_users_reply на локальной заглушке Moltin
+        с поддельными обновлениями Telegram. Выводит перцентили времени по состояниям и число запросов к API.
+        '''
+    )
+    parser.add_argument('-u', '--users', type=int, default=50, help='число пользователей, проходящих диалог')
+    parser.add_argument('--latency-ms', type=float, default=30, help='задержка ответов заглушки, мс')
+    parser.add_argument('--jitter-ms', type=float, default=10, help='разброс задержки заглушки, мс')
+    parser.add_argument('--error-rate', type=float, default=0, help='доля ответов 503 от заглушки')
+    parser.add_argument('--seed', type=int, default=1, help='начальное значение генератора случайных чисел')
+    parser.add_argument('--json', help='сохранить результаты в json-файл')
+
+    return parser
+
+
+def run_benchmark(users, latency_ms, jitter_ms, error_rate):
+    stub = MoltinStub(latency_ms=latency_ms, jitter_ms=jitter_ms, error_rate=error_rate).start(port=0)
+    shop_api.configure_session()
+    shop_api.configure_api_url(stub.base_url)
+
+    os.chdir(tempfile.mkdtemp(prefix='pizza-bench-'))
+    configure_catalog()
+    configure_state_store()
+    configure_photo_cache()
+    image_store = configure_image_store()
+
+    token_manager = TokenManager('bench', 'bench').start()
+    configure_durable_jobs()
+    configure_customer_sync().start(token_manager.get_access_token)
+    configure_cart_buffer()
+    pizzeria_directory = PizzeriaDirectory(
+        lambda: shop_api.iter_entries(token_manager.get_access_token(), 'pizzerias', prefetch=True)
+    )
+    pizzeria_directory.refresh()
+    delivery_zones = DeliveryZones(pizzeria_directory.get_locator)
+    delivery_zones.reload()
+    image_store.prewarm(token_manager.get_access_token(), catalog.get_products(token_manager.get_access_token()))
+
+    bot = FakeBot()
+    cart_buffer.start(
+        token_manager.get_access_token,
+        on_failure=lambda cart_id, product_id, amount: pizza_bot.notify_cart_failure(bot, cart_id)
+    )
+    pizza_bot.register_order_jobs(durable_jobs, bot)
+    durable_jobs.start()
+    bot_data = {
+        'token_manager': token_manager,
+        'pizzeria_directory': pizzeria_directory,
+        'delivery_zones': delivery_zones,
+        'payment_provider_token': 'bench',
+    }
+    job_queue = FakeJobQueue()
+
+    with open(EXAMPLE_DIR / 'addresses.json', 'rb') as f:
+        coordinates = [address['coordinates'] for address in json.load(f)]
+    product_ids = list(stub.products)
+
+    latencies = {}
+    remote_calls = {}
+    for chat_id in range(1, users + 1):
+        place = random.choice(coordinates)
+        location = (
+            float(place['lat']) + random.uniform(-0.02, 0.02),
+            float(place['lon']) + random.uniform(-0.02, 0.02),
+        )
+        user_data = {}
+        context = SimpleNamespace(bot=bot, bot_data=bot_data, user_data=user_data, job_queue=job_queue)
+
+        for make_update in build_scenario(bot, chat_id, random.choice(product_ids), location):
+            update = make_update()
+            if update.message and update.message.text == '/start':
+                state = 'START'
+            else:
+                state = pizza_bot.state_store.get(chat_id)
+
+            calls_before = sum(stub.stats().values())
+            started_at = time.perf_counter()
+            pizza_bot.handle_users_reply(update, context)
+            elapsed = time.perf_counter() - started_at
+            # Запросы фоновых потоков, вызванные шагом, засчитываются этому шагу
+            cart_buffer.drain()
+            durable_jobs.wait_idle()
+            image_store.wait()
+            calls = sum(stub.stats().values()) - calls_before
+
+            latencies.setdefault(state, []).append(elapsed)
+            remote_calls.setdefault(state, []).append(calls)
+
+    cart_buffer.stop()
+    pizzeria_directory.stop()
+    durable_jobs.stop()
+    token_manager.stop()
+    stub.stop()
+
+    return {
+        'users': users,
+        'telegram_calls': bot.calls,
+        'endpoints': stub.stats(),
+        'states': {
+            state: {
+                'steps': len(latencies[state]),
+                'p50_ms': percentile(latencies[state], 0.5) * 1000,
+                'p95_ms': percentile(latencies[state], 0.95) * 1000,
+                'p99_ms': percentile(latencies[state], 0.99) * 1000,
+                'max_ms': max(latencies[state]) * 1000,
+                'remote_calls_per_step': sum(remote_calls[state]) / len(remote_calls[state]),
+            }
+            for state in latencies
+        },
+    }
+
+
+def print_report(report):
+    print(f'Пользователей: {report["users"]}')
+    print(f'{"Состояние":<20}{"шагов":>7}{"p50, мс":>10}{"p95, мс":>10}{"p99, мс":>10}{"max, мс":>10}{"API/шаг":>9}')
+    for state, row in report['states'].items():
+        print(
+            f'{state:<20}{row["steps"]:>7}{row["p50_ms"]:>10.1f}{row["p95_ms"]:>10.1f}'
+            f'{row["p99_ms"]:>10.1f}{row["max_ms"]:>10.1f}{row["remote_calls_per_step"]:>9.2f}'
+        )
+    print(f'Запросы к API по эндпоинтам: {report["endpoints"]}')
+    print(f'Вызовы Telegram: {report["telegram_calls"]}')
+
+
+if __name__ == '__main__':
+    args = create_parser().parse_args()
+    random.seed(args.seed)
+    output_path = Path(args.json).resolve() if args.json else None
+
+    report = run_benchmark(args.users, args.latency_ms, args.jitter_ms, args.error_rate)
+    print_report(report)
+
+    if output_path:
+        with open(output_path, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
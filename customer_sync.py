@@ -0,0 +1,75 @@
+import requests
+
+from shop_api import fetch_customer_by_email, add_customer, update_customer
+from durable_jobs import durable_jobs
+from metrics import registry
+from state_store import StateStore, DEFAULT_STATE_PATH
+
+
+JOB_KIND = 'customer_sync'
+
+SYNCS = registry.counter('customer_sync_total', 'Синхронизация покупателей с интернет-магазином', ['result'])
+
+
+class CustomerSync:
+    # email -> (id покупателя, последние записанные данные)
+
+    def __init__(self, store=None, jobs=durable_jobs):
+        self.store = store or StateStore(table='customers', max_cached=1000)
+        self.jobs = jobs
+        self._get_access_token = None
+
+    def submit(self, customer):
+        entry = self.store.get(customer['email'])
+        if entry and entry['customer'] == customer:
+            SYNCS.inc(result='unchanged')
+            return False
+
+        self.jobs.enqueue(JOB_KIND, customer, key=f'{JOB_KIND}:{customer["email"]}', coalesce=True)
+
+        return True
+
+    def sync(self, customer):
+        email = customer['email']
+        entry = self.store.get(email)
+        if entry and entry['customer'] == customer:
+            SYNCS.inc(result='unchanged')
+            return
+
+        access_token = self._get_access_token()
+        customer_id = entry['id'] if entry else None
+        if customer_id is None:
+            found = fetch_customer_by_email(access_token, email)
+            customer_id = found[0]['id'] if found else None
+
+        if customer_id is not None:
+            try:
+                update_customer(access_token, customer_id, customer)
+                SYNCS.inc(result='updated')
+            except requests.exceptions.HTTPError as err:
+                if err.response is None or err.response.status_code != 404:
+                    raise
+                # Покупателя удалили в интернет-магазине, создаём заново
+                customer_id = None
+
+        if customer_id is None:
+            customer_id = add_customer(access_token, customer)['data']['id']
+            SYNCS.inc(result='created')
+
+        self.store[email] = {'id': customer_id, 'customer': customer}
+
+    def start(self, get_access_token):
+        self._get_access_token = get_access_token
+        self.jobs.register(JOB_KIND, self.sync)
+
+        return self
+
+
+customer_sync = CustomerSync()
+
+
+def configure_customer_sync(path=DEFAULT_STATE_PATH):
+    customer_sync.store.path = path
+    customer_sync.store.start()
+
+    return customer_sync
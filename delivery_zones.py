@@ -0,0 +1,297 @@
+import os
+import json
+import logging
+import time
+import threading
+from dataclasses import dataclass
+from math import cos, floor, radians
+
+from geopy.distance import distance
+
+from metrics import registry
+from pizzeria_directory import Pizzeria
+from pizzeria_locator import EARTH_RADIUS_KM, chord_to_km, squared_chord, to_unit_vector
+
+
+logger = logging.getLogger(__name__)
+
+# (до скольких км включительно, стоимость доставки)
+DEFAULT_TIERS = ((0.5, 0), (5.0, 100), (20.0, 300))
+DEFAULT_TIERS_PATH = 'delivery_tiers.json'
+DEFAULT_PRECISION = 6
+DEFAULT_REFINE_LEVELS = 1
+DEFAULT_RELOAD_INTERVAL = 60
+KM_PER_DEGREE = radians(1) * EARTH_RADIUS_KM
+# Наибольшее отличие расстояния по сфере от геодезического
+SPHERE_ERROR = 0.006
+# Уровень выбирается по расстоянию, округленному как при показе
+DISTANCE_DIGITS = 1
+NEAREST_CANDIDATES = 3
+
+LOOKUPS = registry.counter('delivery_zone_lookups_total', 'Расчёт доставки по таблице зон', ['result'])
+
+
+def cell_size(precision):
+    # Размеры ячейки geohash в градусах
+    bits = precision * 5
+    lon_bits = (bits + 1) // 2
+    lat_bits = bits // 2
+
+    return 180 / 2 ** lat_bits, 360 / 2 ** lon_bits
+
+
+def load_tiers(path):
+    with open(path, 'r', encoding='utf-8') as file:
+        tiers = json.load(file)
+
+    return tuple(sorted((float(tier['max_km']), tier['price']) for tier in tiers))
+
+
+def geodesic_km(location, pizzeria):
+    return distance(location, (pizzeria.latitude, pizzeria.longitude)).km
+
+
+def shown_km(distance_km):
+    return round(distance_km, DISTANCE_DIGITS)
+
+
+def find_tier(tiers, distance_km):
+    for index, (max_km, _) in enumerate(tiers):
+        if distance_km <= max_km:
+            return index
+
+    return None
+
+
+@dataclass(frozen=True)
+class DeliveryQuote:
+    pizzeria: Pizzeria
+    distance_km: float
+    tier: int
+    price: int
+    tiers: tuple
+
+    @property
+    def is_deliverable(self):
+        return self.tier is not None
+
+    @property
+    def is_last_tier(self):
+        return self.tier == len(self.tiers) - 1
+
+
+def exact_quote(locator, tiers, location):
+    # Кандидаты ищутся по сфере, выбор - по геодезическому расстоянию
+    candidates = locator.nearest(location, k=NEAREST_CANDIDATES)
+    closest_km = candidates[0][1] * (1 + SPHERE_ERROR)
+    pizzeria, distance_km = min(
+        (
+            (pizzeria, geodesic_km(location, pizzeria))
+            for pizzeria, sphere_km in candidates
+            if sphere_km * (1 - SPHERE_ERROR) <= closest_km
+        ),
+        key=lambda candidate: candidate[1]
+    )
+    tier = find_tier(tiers, shown_km(distance_km))
+
+    return DeliveryQuote(pizzeria, distance_km, tier, None if tier is None else tiers[tier][1], tiers)
+
+
+class ZoneTable:
+    # Ячейка geohash -> (ближайшая пиццерия, уровень доставки)
+
+    def __init__(self, locator, tiers, precision=DEFAULT_PRECISION, refine_levels=DEFAULT_REFINE_LEVELS):
+        self.locator = locator
+        self.tiers = tiers
+        self.levels = [cell_size(level) for level in range(precision, precision + refine_levels + 1)]
+        self.cells = [{} for _ in self.levels]
+        self._compile()
+
+    def _cell(self, level, latitude, longitude):
+        lat_step, lon_step = self.levels[level]
+        return level, floor((latitude + 90) / lat_step), floor((longitude + 180) / lon_step)
+
+    def _children(self, cell):
+        level, lat_index, lon_index = cell
+        lat_step, lon_step = self.levels[level]
+        child_lat_step, child_lon_step = self.levels[level + 1]
+        lat_ratio, lon_ratio = round(lat_step / child_lat_step), round(lon_step / child_lon_step)
+
+        return [
+            (level + 1, lat_index * lat_ratio + lat_offset, lon_index * lon_ratio + lon_offset)
+            for lat_offset in range(lat_ratio)
+            for lon_offset in range(lon_ratio)
+        ]
+
+    def _compile(self):
+        if not len(self.locator) or not self.tiers:
+            return
+
+        started_at = time.monotonic()
+        lat_step, _ = self.levels[0]
+        radius_km = self.tiers[-1][0]
+        lat_margin = radius_km / KM_PER_DEGREE + lat_step
+        cells = set()
+        for pizzeria in self.locator.pizzerias:
+            latitude, longitude = pizzeria.latitude, pizzeria.longitude
+            lon_margin = lat_margin / max(cos(radians(min(abs(latitude) + lat_margin, 89))), 0.01)
+            _, lat_from, lon_from = self._cell(0, latitude - lat_margin, longitude - lon_margin)
+            _, lat_to, lon_to = self._cell(0, latitude + lat_margin, longitude + lon_margin)
+            cells.update(
+                (0, lat_index, lon_index)
+                for lat_index in range(lat_from, lat_to + 1)
+                for lon_index in range(lon_from, lon_to + 1)
+            )
+
+        # Одинаковые записи хранятся одним объектом
+        entries = {}
+        pending = [(cell, None) for cell in cells]
+        while pending:
+            cell, candidates = pending.pop()
+            level, lat_index, lon_index = cell
+            entry, candidates = self._classify(cell, candidates)
+            if entry is not None:
+                self.cells[level][lat_index << 32 | lon_index] = entries.setdefault(entry, entry)
+            elif level + 1 < len(self.levels):
+                # None - смотреть ячейку следующего уровня
+                self.cells[level][lat_index << 32 | lon_index] = None
+                pending.extend((child, candidates) for child in self._children(cell))
+
+        logger.info(
+            f'Таблица зон доставки: {sum(map(len, self.cells))} ячеек за {time.monotonic() - started_at:.1f} с'
+        )
+
+    def _classify(self, cell, candidates):
+        # Возвращает запись таблицы или кандидатов в ближайшие для ячейки
+        level, lat_index, lon_index = cell
+        lat_step, lon_step = self.levels[level]
+        south = lat_index * lat_step - 90
+        center = (south + lat_step / 2, lon_index * lon_step - 180 + lon_step / 2)
+        # Ширина ячейки наибольшая у края, ближнего к экватору
+        widest_latitude = min(abs(south), abs(south + lat_step)) if south * (south + lat_step) > 0 else 0
+        height_km = lat_step * KM_PER_DEGREE
+        width_km = lon_step * KM_PER_DEGREE * cos(radians(widest_latitude))
+        half_diagonal = (height_km ** 2 + width_km ** 2) ** 0.5 / 2
+
+        if candidates is None:
+            nearest = [(distance_km, pizzeria, None) for pizzeria, distance_km in self.locator.nearest(center, k=2)]
+        else:
+            target = to_unit_vector(*center)
+            nearest = sorted(
+                (chord_to_km(squared_chord(target, point) ** 0.5), pizzeria, point)
+                for pizzeria, point in candidates
+            )
+        distance_km, pizzeria, _ = nearest[0]
+
+        # Запас на размер ячейки и отличие геодезического расстояния от сферического
+        farthest_km = (distance_km + half_diagonal) * (1 + SPHERE_ERROR)
+        if len(nearest) == 1 or (nearest[1][0] - half_diagonal) * (1 - SPHERE_ERROR) > farthest_km:
+            tier = find_tier(self.tiers, shown_km(farthest_km))
+            closest_km = max(0, distance_km - half_diagonal) * (1 - SPHERE_ERROR)
+            if tier == find_tier(self.tiers, shown_km(closest_km)):
+                return (pizzeria, tier), None
+
+        reach_km = farthest_km / (1 - SPHERE_ERROR) + half_diagonal
+        if candidates is None:
+            return None, [
+                (pizzeria, to_unit_vector(pizzeria.latitude, pizzeria.longitude))
+                for pizzeria, _ in self.locator.within(center, reach_km)
+            ]
+
+        return None, [(pizzeria, point) for distance_km, pizzeria, point in nearest if distance_km <= reach_km]
+
+    def _lookup(self, latitude, longitude):
+        for level, cells in enumerate(self.cells):
+            _, lat_index, lon_index = self._cell(level, latitude, longitude)
+            entry = cells.get(lat_index << 32 | lon_index, False)
+            if entry is not None:
+                return entry or None
+
+        return None
+
+    def quote(self, location):
+        latitude, longitude = float(location[0]), float(location[1])
+        entry = self._lookup(latitude, longitude)
+        if entry is None:
+            LOOKUPS.inc(result='exact')
+            return exact_quote(self.locator, self.tiers, (latitude, longitude))
+
+        # Уровень уже известен из ячейки, для показа хватает расстояния по сфере
+        LOOKUPS.inc(result='table')
+        pizzeria, tier = entry
+        distance_km = self.locator.distance((latitude, longitude), pizzeria)
+        price = None if tier is None else self.tiers[tier][1]
+
+        return DeliveryQuote(pizzeria, distance_km, tier, price, self.tiers)
+
+
+class DeliveryZones:
+    # Пока таблица строится в фоне, доставка считается точно
+
+    def __init__(self, get_locator, tiers_path=DEFAULT_TIERS_PATH, precision=DEFAULT_PRECISION,
+                 refine_levels=DEFAULT_REFINE_LEVELS, reload_interval=DEFAULT_RELOAD_INTERVAL):
+        self.get_locator = get_locator
+        self.tiers_path = tiers_path
+        self.precision = precision
+        self.refine_levels = refine_levels
+        self.reload_interval = reload_interval
+        self.tiers = DEFAULT_TIERS
+        self.table = None
+        self._tiers_stamp = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _read_tiers_stamp(self):
+        try:
+            return os.stat(self.tiers_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def reload_tiers(self):
+        stamp = self._read_tiers_stamp()
+        if stamp != self._tiers_stamp:
+            self.tiers = DEFAULT_TIERS if stamp is None else load_tiers(self.tiers_path)
+            self._tiers_stamp = stamp
+            logger.info(f'Уровни доставки: {self.tiers}')
+
+        return self.tiers
+
+    def reload(self):
+        tiers = self.reload_tiers()
+        locator = self.get_locator()
+        table = self.table
+        if table is not None and table.locator is locator and table.tiers is tiers:
+            return False
+
+        self.table = ZoneTable(locator, tiers, self.precision, self.refine_levels)
+
+        return True
+
+    def quote(self, location):
+        table = self.table
+        locator = self.get_locator()
+        if table is None or table.locator is not locator or table.tiers is not self.tiers:
+            LOOKUPS.inc(result='exact')
+            return exact_quote(locator, self.tiers, location)
+
+        return table.quote(location)
+
+    def _run(self):
+        while True:
+            try:
+                self.reload()
+            except (OSError, ValueError, KeyError, TypeError) as err:
+                logger.warning(f'Не удалось перестроить зоны доставки: {err}')
+
+            if self._stop.wait(self.reload_interval):
+                return
+
+    def start(self):
+        self.reload_tiers()
+        self._thread = threading.Thread(target=self._run, name='delivery-zones', daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self):
+        self._stop.set()
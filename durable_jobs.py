@@ -0,0 +1,249 @@
+import json
+import time
+import logging
+import sqlite3
+import threading
+
+from metrics import registry
+from state_store import DEFAULT_STATE_PATH
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_ATTEMPTS = 8
+DEFAULT_BACKOFF = 2
+MAX_BACKOFF = 15 * 60
+DEFAULT_RETENTION = 7 * 24 * 60 * 60
+IDLE_WAIT = 5
+MIN_WAIT = 0.05
+
+JOBS = registry.counter('durable_jobs_total', 'Фоновые задания по результату', ['kind', 'result'])
+PENDING = registry.gauge('durable_jobs_pending', 'Фоновые задания, ожидающие выполнения')
+
+
+class DurableJobs:
+    # Задания в SQLite, ключ задания защищает от повторной постановки
+
+    def __init__(self, path=DEFAULT_STATE_PATH, workers=DEFAULT_WORKERS,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS, backoff=DEFAULT_BACKOFF):
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._handlers = {}
+        self._running = set()
+        self._connection = None
+        self._db_lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def _connect(self):
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    key TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    run_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    last_error TEXT
+                )
+                '''
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, run_at)')
+            self._connection = connection
+
+        return self._connection
+
+    def _execute(self, query, params=()):
+        with self._db_lock:
+            return self._connect().execute(query, params)
+
+    def _update_pending_gauge(self):
+        row = self._execute("SELECT COUNT(*) FROM jobs WHERE status = 'pending'").fetchone()
+        PENDING.set(row[0])
+
+    def register(self, kind, handler):
+        self._handlers[kind] = handler
+
+    def enqueue(self, kind, payload, key, delay=0, coalesce=False):
+        # coalesce=True: задание с тем же ключом получает новые данные
+        now = time.time()
+        row = (key, kind, json.dumps(payload, ensure_ascii=False), now + delay, now)
+        if coalesce:
+            cursor = self._execute(
+                '''
+                INSERT INTO jobs (key, kind, payload, status, run_at, updated_at) VALUES (?, ?, ?, 'pending', ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    payload = excluded.payload, run_at = excluded.run_at, updated_at = excluded.updated_at,
+                    status = 'pending', attempts = 0, last_error = NULL
+                ''',
+                row
+            )
+        else:
+            cursor = self._execute(
+                "INSERT OR IGNORE INTO jobs (key, kind, payload, status, run_at, updated_at) "
+                "VALUES (?, ?, ?, 'pending', ?, ?)",
+                row
+            )
+
+        accepted = cursor.rowcount > 0
+        JOBS.inc(kind=kind, result='enqueued' if accepted else 'duplicate')
+        if accepted:
+            with self._wakeup:
+                self._wakeup.notify()
+
+        return accepted
+
+    def _claim(self):
+        now = time.time()
+        with self._db_lock:
+            connection = self._connect()
+            rows = connection.execute(
+                "SELECT key, kind, payload, attempts FROM jobs "
+                "WHERE status = 'pending' AND run_at <= ? ORDER BY run_at LIMIT ?",
+                (now, self.workers + 1)
+            ).fetchall()
+            # Задание с тем же ключом, которое сейчас выполняется, не запускаем параллельно
+            for key, kind, payload, attempts in rows:
+                if key not in self._running:
+                    connection.execute(
+                        "UPDATE jobs SET status = 'running', updated_at = ? WHERE key = ?", (now, key)
+                    )
+                    self._running.add(key)
+                    return key, kind, payload, attempts, now
+
+        return None
+
+    def _next_run_at(self):
+        row = self._execute("SELECT MIN(run_at) FROM jobs WHERE status = 'pending'").fetchone()
+        return row[0]
+
+    def _finish(self, key, claimed_at, status, attempts, run_at=None, error=None):
+        # Задание, получившее новые данные во время выполнения, остаётся в очереди
+        self._execute(
+            '''
+            UPDATE jobs SET status = ?, attempts = ?, run_at = COALESCE(?, run_at), updated_at = ?, last_error = ?
+            WHERE key = ? AND updated_at = ?
+            ''',
+            (status, attempts, run_at, time.time(), error, key, claimed_at)
+        )
+
+    def _run_job(self, key, kind, payload, attempts, claimed_at):
+        handler = self._handlers.get(kind)
+        attempts += 1
+        try:
+            if handler is None:
+                raise LookupError(f'Нет обработчика для заданий {kind}')
+            handler(json.loads(payload))
+        except Exception as err:
+            if attempts >= self.max_attempts:
+                logger.error(f'Задание {key} не выполнено после {attempts} попыток: {err}')
+                self._finish(key, claimed_at, 'failed', attempts, error=str(err))
+                JOBS.inc(kind=kind, result='failed')
+            else:
+                delay = min(self.backoff * 2 ** (attempts - 1), MAX_BACKOFF)
+                logger.warning(f'Задание {key} не выполнено, повтор через {delay} с: {err}')
+                self._finish(key, claimed_at, 'pending', attempts, run_at=time.time() + delay, error=str(err))
+                JOBS.inc(kind=kind, result='retried')
+            return
+
+        self._finish(key, claimed_at, 'done', attempts)
+        JOBS.inc(kind=kind, result='done')
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                job = self._claim()
+            except sqlite3.Error as err:
+                logger.error(f'Не удалось получить задание из {self.path}: {err}')
+                self._stop.wait(IDLE_WAIT)
+                continue
+
+            if job is None:
+                next_run_at = self._next_run_at()
+                # Ожидающее задание может быть занято другим потоком, поэтому ждём хотя бы немного
+                timeout = IDLE_WAIT if next_run_at is None else min(IDLE_WAIT, max(MIN_WAIT, next_run_at - time.time()))
+                with self._wakeup:
+                    if not self._stop.is_set():
+                        self._wakeup.wait(timeout)
+                continue
+
+            key = job[0]
+            try:
+                self._run_job(*job)
+            finally:
+                with self._db_lock:
+                    self._running.discard(key)
+            self._update_pending_gauge()
+
+    def recover(self, retention=DEFAULT_RETENTION):
+        # Задания, прерванные остановкой бота, выполняются заново
+        recovered = self._execute(
+            "UPDATE jobs SET status = 'pending' WHERE status = 'running'"
+        ).rowcount
+        self._execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (time.time() - retention,)
+        )
+        self._update_pending_gauge()
+        if recovered:
+            logger.info(f'Возобновлено прерванных заданий: {recovered}')
+
+        return recovered
+
+    def wait_idle(self, timeout=None):
+        # Ждёт, пока не останется выполняемых заданий и заданий, срок которых уже наступил
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            row = self._execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'running' OR (status = 'pending' AND run_at <= ?)",
+                (time.time(),)
+            ).fetchone()
+            if not row[0]:
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(MIN_WAIT)
+
+    def start(self):
+        if not self._threads:
+            self.recover()
+            self._stop.clear()
+            for number in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'durable-jobs-{number}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+        return self
+
+    def stop(self):
+        with self._wakeup:
+            self._stop.set()
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+        with self._db_lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+durable_jobs = DurableJobs()
+
+
+def configure_durable_jobs(path=DEFAULT_STATE_PATH, workers=DEFAULT_WORKERS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    durable_jobs.path = path
+    durable_jobs.workers = workers
+    durable_jobs.max_attempts = max_attempts
+
+    return durable_jobs
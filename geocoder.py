@@ -0,0 +1,140 @@
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import requests
+from geopy import Yandex
+from geopy.exc import GeopyError
+
+from metrics import registry
+from state_store import StateStore, DEFAULT_STATE_PATH
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MEMORY_SIZE = 5000
+DEFAULT_NEGATIVE_TTL = 24 * 60 * 60
+DEFAULT_GEOCODER_TIMEOUT = 5
+
+ABBREVIATIONS = {
+    'г': 'город',
+    'гор': 'город',
+    'ул': 'улица',
+    'пр': 'проспект',
+    'пр-т': 'проспект',
+    'просп': 'проспект',
+    'пер': 'переулок',
+    'наб': 'набережная',
+    'б-р': 'бульвар',
+    'бул': 'бульвар',
+    'ш': 'шоссе',
+    'пл': 'площадь',
+    'д': 'дом',
+    'к': 'корпус',
+    'корп': 'корпус',
+    'стр': 'строение',
+}
+
+REQUEST_SECONDS = registry.histogram('geocoder_request_duration_seconds', 'Время запроса к Яндекс.Геокодеру')
+LOOKUPS = registry.counter('geocoder_lookups_total', 'Поиск адресов в кэше геокодера', ['result'])
+
+
+def normalize_address(address):
+    address = address.lower().replace('ё', 'е')
+    address = re.sub(r'[,.;:"«»()]', ' ', address)
+    words = [ABBREVIATIONS.get(word, word) for word in address.split()]
+
+    return ' '.join(words)
+
+
+class CachedGeocoder:
+    # Память (LRU) -> SQLite -> Яндекс.Геокодер
+
+    def __init__(self, api_key=None, store=None, memory_size=DEFAULT_MEMORY_SIZE,
+                 negative_ttl=DEFAULT_NEGATIVE_TTL, timeout=DEFAULT_GEOCODER_TIMEOUT):
+        self.store = store or StateStore(table='geocode', max_cached=0)
+        self.memory_size = memory_size
+        self.negative_ttl = negative_ttl
+        self.timeout = timeout
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._client = None
+        self.api_key = api_key
+
+    def configure(self, api_key, memory_size=DEFAULT_MEMORY_SIZE, negative_ttl=DEFAULT_NEGATIVE_TTL):
+        self.api_key = api_key
+        self.memory_size = memory_size
+        self.negative_ttl = negative_ttl
+        self._client = None
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = Yandex(api_key=self.api_key, timeout=self.timeout)
+
+        return self._client
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+        result = 'memory'
+
+        if entry is None:
+            entry = self.store.get(key)
+            if entry is not None:
+                self._remember(key, entry)
+            result = 'disk'
+
+        if entry is None or (entry['coordinates'] is None and time.time() - entry['created_at'] > self.negative_ttl):
+            LOOKUPS.inc(result='miss')
+            return None
+
+        LOOKUPS.inc(result=result)
+
+        return entry
+
+    def fetch_coordinates(self, address):
+        key = normalize_address(address)
+        entry = self._lookup(key)
+
+        if entry is None:
+            try:
+                with REQUEST_SECONDS.time():
+                    location = self._get_client().geocode(address)
+            except (requests.exceptions.HTTPError, GeopyError) as err:
+                # Сбой геокодера не означает, что адреса не существует, поэтому не кэшируем
+                logger.warning(f'Ошибка геокодера для "{address}": {err}')
+                return None
+
+            entry = {
+                'coordinates': (location.latitude, location.longitude) if location else None,
+                'created_at': time.time(),
+            }
+            self._remember(key, entry)
+            self.store[key] = entry
+
+        if entry['coordinates']:
+            lat, lon = entry['coordinates']
+            return lat, lon
+
+
+geocoder = CachedGeocoder()
+
+
+def configure_geocoder(api_key, path=DEFAULT_STATE_PATH, memory_size=DEFAULT_MEMORY_SIZE,
+                       negative_ttl=DEFAULT_NEGATIVE_TTL):
+    geocoder.configure(api_key, memory_size=memory_size, negative_ttl=negative_ttl)
+    geocoder.store.path = path
+    geocoder.store.start()
+
+    return geocoder
@@ -0,0 +1,161 @@
+import re
+import time
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from metrics import registry
+
+
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+DEFAULT_MAX_ENTRY_BYTES = 1024 * 1024
+
+# Путь запроса -> сколько секунд ответ свежий, 0 - перепроверять каждый раз
+DEFAULT_POLICIES = (
+    (r'/v2/files/[^/]+', 60 * 60),
+    (r'/v2/products/[^/]+', 60),
+    (r'/v2/products', 0),
+    (r'/v2/flows', 5 * 60),
+    (r'/v2/flows/[^/]+/entries(/[^/]+)?', 0),
+)
+
+LOOKUPS = registry.counter('moltin_cache_total', 'Обращения к кэшу ответов Moltin', ['endpoint', 'result'])
+CACHED_BYTES = registry.gauge('moltin_cache_bytes', 'Объём кэша ответов Moltin')
+
+
+class CachedResponse:
+
+    def __init__(self, response):
+        self.body = response.content
+        self.headers = dict(response.headers)
+        self.etag = response.headers.get('ETag')
+        self.last_modified = response.headers.get('Last-Modified')
+        self.stored_at = time.monotonic()
+
+    @property
+    def size(self):
+        return len(self.body)
+
+    def build_response(self, request):
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = 'OK'
+        response.headers = CaseInsensitiveDict(self.headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = self.body
+        response._content_consumed = True
+        response.url = request.url
+        response.request = request
+
+        return response
+
+
+class ResponseCache:
+    # LRU по объёму, ключ - полный URL
+
+    def __init__(self, policies=DEFAULT_POLICIES, max_bytes=DEFAULT_MAX_BYTES, max_entry_bytes=DEFAULT_MAX_ENTRY_BYTES):
+        self.policies = [(re.compile(pattern), max_age) for pattern, max_age in policies]
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def max_age(self, url):
+        path = urlparse(url).path
+        for pattern, max_age in self.policies:
+            if pattern.fullmatch(path):
+                return max_age
+
+        return None
+
+    def get(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+
+            return entry
+
+    def _remove(self, url):
+        entry = self._entries.pop(url, None)
+        if entry is not None:
+            self._size -= entry.size
+
+    def put(self, url, response):
+        entry = CachedResponse(response)
+        if entry.size > self.max_entry_bytes:
+            return None
+
+        with self._lock:
+            self._remove(url)
+            self._entries[url] = entry
+            self._size += entry.size
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+            CACHED_BYTES.set(self._size)
+
+        return entry
+
+    def touch(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                entry.stored_at = time.monotonic()
+
+    def invalidate(self, url):
+        # Запись в ресурс делает устаревшими и его, и список, в который он входит
+        path = urlparse(url).path.rstrip('/')
+        parent = path.rsplit('/', 1)[0]
+        with self._lock:
+            for cached_url in list(self._entries):
+                cached_path = urlparse(cached_url).path.rstrip('/')
+                if cached_path in (path, parent) or cached_path.startswith(f'{path}/'):
+                    self._remove(cached_url)
+            CACHED_BYTES.set(self._size)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            CACHED_BYTES.set(0)
+
+    def send(self, request, send, endpoint):
+        # send(request) выполняет настоящий запрос
+        if request.method != 'GET':
+            response = send(request)
+            if response.ok:
+                self.invalidate(request.url)
+            return response
+
+        max_age = self.max_age(request.url)
+        if max_age is None:
+            return send(request)
+
+        entry = self.get(request.url)
+        if entry is not None and time.monotonic() - entry.stored_at < max_age:
+            LOOKUPS.inc(endpoint=endpoint, result='hit')
+            return entry.build_response(request)
+
+        if entry is not None:
+            if entry.etag:
+                request.headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                request.headers['If-Modified-Since'] = entry.last_modified
+
+        response = send(request)
+        if response.status_code == 304 and entry is not None:
+            response.close()
+            self.touch(request.url)
+            LOOKUPS.inc(endpoint=endpoint, result='revalidated')
+            return entry.build_response(request)
+
+        LOOKUPS.inc(endpoint=endpoint, result='miss')
+        if response.status_code == 200 and not response.headers.get('Cache-Control', '').startswith('no-store'):
+            self.put(request.url, response)
+
+        return response
@@ -0,0 +1,233 @@
+import io
+import os
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, urlparse
+
+import requests
+from PIL import Image
+
+import shop_api
+from catalog import catalog
+from photo_cache import get_main_image_id
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_IMAGES_DIR = 'images'
+DEFAULT_MAX_BYTES = 200 * 1024 * 1024
+DEFAULT_MAX_SIDE = 1280
+DEFAULT_WORKERS = 4
+DEFAULT_PREWARM_INTERVAL = 60
+CHUNK_SIZE = 64 * 1024
+JPEG_QUALITY = 85
+
+
+def image_filename(image_url):
+    return os.path.basename(unquote(urlparse(image_url).path))
+
+
+class ImageStore:
+    # Картинки товаров заранее скачиваются в фоне в каталог ограниченного размера
+
+    def __init__(self, directory=DEFAULT_IMAGES_DIR, max_bytes=DEFAULT_MAX_BYTES,
+                 max_side=DEFAULT_MAX_SIDE, workers=DEFAULT_WORKERS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_side = max_side
+        self.workers = workers
+        self._urls = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._warmed_version = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='image')
+
+            return self._executor
+
+    def get_image_url(self, access_token, product):
+        image_id = get_main_image_id(product)
+        image_url = self._urls.get(image_id)
+        if image_url is None:
+            image_url = shop_api.take_product_image_description(access_token, product)['url']
+            self._urls[image_id] = image_url
+
+        return image_url
+
+    def get_path(self, image_url):
+        path = os.path.join(self.directory, image_filename(image_url))
+        try:
+            # Время изменения файла служит отметкой последнего использования для вытеснения
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+
+        return path
+
+    def _resize(self, path):
+        # Формат сохраняется; если Pillow не справился, остаются исходные байты
+        buffer = io.BytesIO()
+        try:
+            with Image.open(path) as image:
+                if max(image.size) <= self.max_side:
+                    return
+                image_format = image.format
+                image.thumbnail((self.max_side, self.max_side))
+                if image_format == 'JPEG':
+                    if image.mode not in ('RGB', 'L'):
+                        image = image.convert('RGB')
+                    image.save(buffer, format=image_format, quality=JPEG_QUALITY, optimize=True)
+                else:
+                    image.save(buffer, format=image_format)
+        except (OSError, ValueError, Image.DecompressionBombError) as err:
+            logger.warning(f'Не удалось уменьшить картинку {path}, сохраняем как есть: {err}')
+            return
+
+        with open(path, 'wb') as file:
+            file.write(buffer.getvalue())
+
+    def download(self, image_url):
+        path = os.path.join(self.directory, image_filename(image_url))
+        if os.path.exists(path):
+            return path
+
+        os.makedirs(self.directory, exist_ok=True)
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as file:
+                with shop_api.session.get(image_url, stream=True) as response:
+                    response.raise_for_status()
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        file.write(chunk)
+            self._resize(temp_path)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+        return path
+
+    def _download_quietly(self, image_url, enforce_budget=True):
+        try:
+            path = self.download(image_url)
+            if enforce_budget:
+                self.enforce_budget()
+            return path
+        except (requests.exceptions.RequestException, OSError) as err:
+            logger.warning(f'Не удалось скачать картинку {image_url}: {err}')
+        finally:
+            with self._lock:
+                self._pending.pop(image_url, None)
+
+    def schedule(self, image_url):
+        executor = self._get_executor()
+        with self._lock:
+            future = self._pending.get(image_url)
+            if future is None:
+                future = executor.submit(self._download_quietly, image_url)
+                self._pending[image_url] = future
+
+        return future
+
+    def wait(self):
+        with self._lock:
+            futures = list(self._pending.values())
+        for future in futures:
+            future.result()
+
+    def _warm_product(self, access_token, product):
+        try:
+            image_url = self.get_image_url(access_token, product)
+        except (requests.exceptions.RequestException, KeyError, TypeError) as err:
+            logger.warning(f'Не удалось получить картинку товара {product.get("id")}: {err}')
+            return None
+
+        return self._download_quietly(image_url, enforce_budget=False)
+
+    def prewarm(self, access_token, products):
+        # Возвращает True, если скачались все картинки
+        executor = self._get_executor()
+        futures = [executor.submit(self._warm_product, access_token, product) for product in products]
+        paths = [future.result() for future in futures]
+        self.enforce_budget()
+
+        return all(path is not None for path in paths)
+
+    def enforce_budget(self):
+        try:
+            entries = [
+                entry for entry in os.scandir(self.directory)
+                if entry.is_file() and not entry.name.endswith('.part')
+            ]
+        except FileNotFoundError:
+            return 0
+
+        files = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries)
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+
+        if removed:
+            logger.info(f'Удалено картинок сверх лимита {self.max_bytes} байт: {removed}')
+
+        return removed
+
+    def _run(self, get_access_token, interval):
+        while True:
+            try:
+                access_token = get_access_token()
+                version, products = catalog.get_versioned_products(access_token)
+                # Каталог проходим заново после обновления или если не все картинки скачались
+                if version != self._warmed_version and self.prewarm(access_token, products):
+                    self._warmed_version = version
+            except requests.exceptions.RequestException as err:
+                logger.warning(f'Не удалось прогреть картинки каталога: {err}')
+
+            if self._stop.wait(interval):
+                return
+
+    def start(self, get_access_token, interval=DEFAULT_PREWARM_INTERVAL):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, args=(get_access_token, interval), name='image-prewarm', daemon=True
+            )
+            self._thread.start()
+
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+image_store = ImageStore()
+
+
+def configure_image_store(directory=DEFAULT_IMAGES_DIR, max_bytes=DEFAULT_MAX_BYTES, max_side=DEFAULT_MAX_SIDE):
+    image_store.directory = directory
+    image_store.max_bytes = max_bytes
+    image_store.max_side = max_side
+    os.makedirs(directory, exist_ok=True)
+
+    return image_store
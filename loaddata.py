@@ -1,18 +1,35 @@
 import json
+import time
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from environs import Env
-from requests.exceptions import HTTPError
+from requests.exceptions import HTTPError, RequestException
+from catalog import invalidate_catalog
+from rate_limit import TokenBucket
+from token_manager import TokenManager
 from shop_api import (
-    client_credentials_access_token,
     create_product,
-    fetch_products,
+    find_product_by_sku,
+    create_file,
+    main_image_relationship,
+    iter_products,
     delete_product,
     delete_files,
     create_flow,
-    create_entries
+    create_entries,
+    find_entry,
+    configure_session_from_env,
+    DEFAULT_POOL_SIZE
 )
 
 
+# Ограничение Moltin на число запросов в секунду для магазина
+DEFAULT_RATE = 20
+DEFAULT_ATTEMPTS = 3
+RETRY_BACKOFF = 1
+
+
 def create_parser():
     parser = argparse.ArgumentParser(
         description='''
@@ -24,17 +41,133 @@ def create_parser():
     parser.add_argument('-a', '--addr', nargs='?', help='json-файл со справочником адресов ресторана')
     parser.add_argument('-tg', '--tg_id', nargs='?', help='Тестовый телеграм ID для отправки уведомлений по доставке')
     parser.add_argument('-d', action='store_true', help='удалить справочники из базы')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='число параллельных потоков загрузки')
+    parser.add_argument('--rate', type=float, default=DEFAULT_RATE, help='не более запросов к API в секунду')
+    parser.add_argument('--attempts', type=int, default=DEFAULT_ATTEMPTS, help='попыток загрузки одной записи')
+    parser.add_argument('--resume', action='store_true', help='пропустить товары меню, созданные прерванной загрузкой')
 
     return parser
 
 
-def upload_menu(access_token):
+class Progress:
+
+    def __init__(self, total):
+        self.total = total
+        self.succeeded = 0
+        self.failed = 0
+        self.started_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def update(self, description, error=None):
+        with self._lock:
+            if error is None:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+            done = self.succeeded + self.failed
+            elapsed = max(time.monotonic() - self.started_at, 1e-6)
+
+        result = 'загружено' if error is None else f'ошибка: {error}'
+        print(f'[{done}/{self.total}] {description} - {result}. Ошибок: {self.failed}, {done / elapsed:.1f} записей/с')
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.started_at, 1e-6)
+        print(
+            f'Готово за {elapsed:.1f} с: загружено {self.succeeded}, ошибок {self.failed}, '
+            f'{(self.succeeded + self.failed) / elapsed:.1f} записей/с'
+        )
+
+
+def is_retryable(err):
+    if isinstance(err, HTTPError) and err.response is not None:
+        status = err.response.status_code
+        return status == 429 or status >= 500
+
+    return True
+
+
+def call_with_retry(step, attempts, find_existing=None):
+    # Повторяется только упавший шаг, перед повтором ищем созданную запись
+    for attempt in range(1, attempts + 1):
+        if attempt > 1 and find_existing is not None:
+            existing = find_existing()
+            if existing is not None:
+                return existing
+        try:
+            return step()
+        except RequestException as err:
+            if attempt == attempts or not is_retryable(err):
+                raise
+            time.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+
+
+def upload_product(token_manager, product, attempts=DEFAULT_ATTEMPTS, resume=False):
+    sku = str(product['id'])
+
+    def find_existing():
+        return find_product_by_sku(token_manager.get_access_token(), sku)
+
+    created = (resume and call_with_retry(find_existing, attempts)) or call_with_retry(
+        lambda: create_product(token_manager.get_access_token(), product),
+        attempts,
+        find_existing=find_existing
+    )
+    if created.get('relationships', {}).get('main_image'):
+        return created
+
+    # Потерянный ответ оставит лишний файл, но не второй товар
+    file_id = call_with_retry(
+        lambda: create_file(token_manager.get_access_token(), product['product_image']['url']),
+        attempts
+    )
+    # Повторная установка той же картинки ничего не меняет, шаг можно повторять
+    call_with_retry(
+        lambda: main_image_relationship(token_manager.get_access_token(), created['id'], file_id),
+        attempts
+    )
+
+    return created
+
+
+def upload_entry(token_manager, flow_slug, entry, attempts=DEFAULT_ATTEMPTS):
+    return call_with_retry(
+        lambda: create_entries(token_manager.get_access_token(), flow_slug, entry),
+        attempts,
+        find_existing=lambda: find_entry(token_manager.get_access_token(), flow_slug, 'alias', entry['alias'])
+    )
+
+
+def run_bulk(task, items, describe, workers=1):
+    progress = Progress(len(items))
+    failed = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(task, item): item for item in items}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                future.result()
+            except RequestException as err:
+                failed.append(item)
+                progress.update(describe(item), error=err)
+            else:
+                progress.update(describe(item))
+
+    progress.summary()
+
+    return failed
+
+
+def upload_menu(token_manager, workers=1, attempts=DEFAULT_ATTEMPTS, resume=False):
     with open('example/menu.json', 'rb') as f:
         menu = json.load(f)
 
-    for item in menu:
-        create_product(access_token, item)
-        print(f'Created: {item["name"]}')
+    return run_bulk(
+        lambda item: upload_product(token_manager, item, attempts, resume),
+        menu,
+        describe=lambda item: item['name'],
+        workers=workers
+    )
 
 
 def create_pizzerias_flow(access_token):
@@ -50,9 +183,9 @@ def create_pizzerias_flow(access_token):
     return flow
 
 
-def upload_addresses(access_token, telegram_id=None):
+def upload_addresses(token_manager, telegram_id=None, workers=1, attempts=DEFAULT_ATTEMPTS):
     try:
-        flow = create_pizzerias_flow(access_token)
+        flow = create_pizzerias_flow(token_manager.get_access_token())
     except HTTPError:
         print('Flow "address" уже загружен. Удалите данные перед повторной загрузкой')
         return
@@ -60,6 +193,7 @@ def upload_addresses(access_token, telegram_id=None):
     with open('example/addresses.json', 'rb') as f:
         addresses = json.load(f)
 
+    entries = []
     for address in addresses:
         entry = {
             'address': address['address']['full'],
@@ -71,37 +205,47 @@ def upload_addresses(access_token, telegram_id=None):
             entry.update({'telegram_id': address['telegram_id']})
         elif telegram_id:
             entry.update({'telegram_id': int(telegram_id)})
+        entries.append(entry)
 
-        create_entries(access_token, flow['slug'], entry)
-        print(f'Upload: {entry["alias"]} {entry["address"]}')
+    return run_bulk(
+        lambda entry: upload_entry(token_manager, flow['slug'], entry, attempts),
+        entries,
+        describe=lambda entry: f'{entry["alias"]} {entry["address"]}',
+        workers=workers
+    )
 
 
 if __name__ == '__main__':
 
+    parser = create_parser()
+    args = parser.parse_args()
+
     env = Env()
     env.read_env()
+    configure_session_from_env(
+        env,
+        pool_size=max(args.workers, env.int('MOTLIN_POOL_SIZE', DEFAULT_POOL_SIZE)),
+        rate_limiter=TokenBucket(args.rate)
+    )
     client_id = env.str('MOTLIN_CLIENT_ID')
     client_secret = env.str('MOTLIN_CLIENT_SECRET')
-    access_token = client_credentials_access_token(client_id, client_secret)['access_token']
-
-    parser = create_parser()
-    args = parser.parse_args()
+    token_manager = TokenManager(client_id, client_secret).start()
 
     if args.menu:
         print('Try load menu')
-        upload_menu(access_token)
+        upload_menu(token_manager, workers=args.workers, attempts=args.attempts, resume=args.resume)
+        invalidate_catalog()
     elif args.addr:
         print('Try load address')
-        if args.tg_id:
-            upload_addresses(access_token, args.tg_id)
-        else:
-            upload_addresses(access_token)
+        upload_addresses(token_manager, args.tg_id, workers=args.workers, attempts=args.attempts)
     elif args.d:
         print('Delete data')
-        products = fetch_products(access_token)
-        for product in products:
-            delete_product(access_token, product['id'])
-        delete_files(access_token)
+        # Удаление сдвигает смещения страниц, поэтому сначала собираем идентификаторы
+        product_ids = [product['id'] for product in iter_products(token_manager.get_access_token(), prefetch=True)]
+        for product_id in product_ids:
+            delete_product(token_manager.get_access_token(), product_id)
+        delete_files(token_manager.get_access_token())
+        invalidate_catalog()
     else:
         parser.print_help()
 
@@ -0,0 +1,61 @@
+import threading
+
+from telegram import InlineKeyboardButton
+
+from catalog import catalog
+
+
+DEFAULT_MENU_STEP = 7
+
+NAVIGATION_ROW = (
+    InlineKeyboardButton(' << ', callback_data='previous'),
+    InlineKeyboardButton(' >> ', callback_data='next'),
+)
+
+
+class MenuPages:
+    # Страницы меню строятся один раз на версию каталога
+
+    def __init__(self, catalog=catalog, step=DEFAULT_MENU_STEP):
+        self.catalog = catalog
+        self.step = step
+        self._snapshot = (None, {}, 0)
+        self._lock = threading.Lock()
+
+    def _build(self, products):
+        pages = {}
+        for start in range(0, len(products) + 1, self.step):
+            rows = tuple(
+                (InlineKeyboardButton(product['name'], callback_data=product['id']),)
+                for product in products[start:start + self.step]
+            )
+            pages[start] = rows + (NAVIGATION_ROW,)
+
+        return pages
+
+    def _get_pages(self, access_token):
+        version, products = self.catalog.get_versioned_products(access_token)
+
+        if self._snapshot[0] != version:
+            with self._lock:
+                if self._snapshot[0] != version:
+                    self._snapshot = (version, self._build(products), len(products))
+
+        _, pages, products_count = self._snapshot
+        return pages, products_count
+
+    def get_page(self, access_token, start):
+        pages, _ = self._get_pages(access_token)
+
+        return pages.get(start) or pages[0]
+
+    def next_start(self, access_token, start, direction):
+        _, products_count = self._get_pages(access_token)
+
+        if direction == 'next':
+            return start if (start + self.step) > products_count else start + self.step
+
+        return 0 if (start - self.step) < 0 else start - self.step
+
+
+menu_pages = MenuPages()
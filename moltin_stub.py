@@ -0,0 +1,456 @@
+import io
+import re
+import json
+import time
+import uuid
+import hashlib
+import random
+import logging
+import argparse
+import threading
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+
+logger = logging.getLogger(__name__)
+
+EXAMPLE_DIR = Path(__file__).resolve().parent / 'example'
+DEFAULT_PORT = 8090
+TOKEN_LIFETIME = 3600
+
+
+def make_fake_image(size=(8, 8)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (220, 120, 40)).save(buffer, format='JPEG')
+
+    return buffer.getvalue()
+
+
+# Настоящий крошечный JPEG, чтобы бот мог его разобрать и сохранить
+FAKE_IMAGE = make_fake_image()
+
+
+def format_price(amount):
+    return f'{amount} ₽'
+
+
+class MoltinStub:
+    # Локальная замена эндпоинтов Moltin с задержкой и долей ответов 503
+
+    def __init__(self, latency_ms=0, jitter_ms=0, error_rate=0.0, seed_examples=True):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.base_url = None
+        self.products = {}
+        self.files = {}
+        self.carts = {}
+        self.customers = {}
+        self.flows = {}
+        self.fields = {}
+        self.entries = {}
+        self.requests = {}
+        self._lock = threading.RLock()
+        self._server = None
+        self._routes = [
+            ('POST', r'/oauth/access_token', self.create_token),
+            ('GET', r'/v2/products', self.list_products),
+            ('POST', r'/v2/products', self.create_product),
+            ('GET', r'/v2/products/(?P<product_id>[^/]+)', self.get_product),
+            ('DELETE', r'/v2/products/(?P<product_id>[^/]+)', self.delete_product),
+            ('POST', r'/v2/products/(?P<product_id>[^/]+)/relationships/main-image', self.set_main_image),
+            ('GET', r'/v2/files', self.list_files),
+            ('POST', r'/v2/files', self.create_file),
+            ('GET', r'/v2/files/(?P<file_id>[^/]+)', self.get_file),
+            ('DELETE', r'/v2/files/(?P<file_id>[^/]+)', self.delete_file),
+            ('GET', r'/v2/carts/(?P<cart_id>[^/]+)', self.get_cart),
+            ('DELETE', r'/v2/carts/(?P<cart_id>[^/]+)', self.delete_cart),
+            ('GET', r'/v2/carts/(?P<cart_id>[^/]+)/items', self.get_cart_items),
+            ('POST', r'/v2/carts/(?P<cart_id>[^/]+)/items', self.add_cart_item),
+            ('PUT', r'/v2/carts/(?P<cart_id>[^/]+)/items/(?P<item_id>[^/]+)', self.update_cart_item),
+            ('DELETE', r'/v2/carts/(?P<cart_id>[^/]+)/items/(?P<item_id>[^/]+)', self.delete_cart_item),
+            ('GET', r'/v2/customers', self.list_customers),
+            ('POST', r'/v2/customers', self.create_customer),
+            ('PUT', r'/v2/customers/(?P<customer_id>[^/]+)', self.update_customer),
+            ('GET', r'/v2/flows', self.list_flows),
+            ('POST', r'/v2/flows', self.create_flow),
+            ('DELETE', r'/v2/flows/(?P<flow_id>[^/]+)', self.delete_flow),
+            ('POST', r'/v2/fields', self.create_field),
+            ('GET', r'/v2/flows/(?P<flow_slug>[^/]+)/entries', self.list_entries),
+            ('POST', r'/v2/flows/(?P<flow_slug>[^/]+)/entries', self.create_entry),
+            ('GET', r'/v2/flows/(?P<flow_slug>[^/]+)/entries/(?P<entry_id>[^/]+)', self.get_entry),
+            ('GET', r'/images/(?P<file_name>[^/]+)', self.get_image),
+        ]
+        self._routes = [
+            (method, re.compile(f'{pattern}$'), re.sub(r'\(\?P<(\w+)>[^)]*\)', r'{\1}', pattern), handler)
+            for method, pattern, handler in self._routes
+        ]
+
+        if seed_examples:
+            self.seed_examples()
+
+    def seed_examples(self):
+        with open(EXAMPLE_DIR / 'menu.json', 'rb') as f:
+            for item in json.load(f):
+                product = self._new_product({
+                    'name': item['name'],
+                    'sku': str(item['id']),
+                    'description': item['description'],
+                    'price': [{'amount': item['price'], 'currency': 'RUB', 'includes_tax': True}],
+                })
+                file = self._new_file(item['product_image']['url'])
+                product['relationships'] = {'main_image': {'data': {'type': 'main_image', 'id': file['id']}}}
+
+        self.flows['pizzerias'] = {'id': str(uuid.uuid4()), 'type': 'flow', 'slug': 'pizzerias', 'name': 'Pizzerias'}
+        with open(EXAMPLE_DIR / 'addresses.json', 'rb') as f:
+            for address in json.load(f):
+                self._new_entry('pizzerias', {
+                    'address': address['address']['full'],
+                    'alias': address['alias'],
+                    'longitude': float(address['coordinates']['lon']),
+                    'latitude': float(address['coordinates']['lat']),
+                    'telegram_id': address.get('telegram_id'),
+                })
+
+    def _new_product(self, data):
+        product = {'type': 'product', 'status': 'live', 'relationships': {}, **data, 'id': str(uuid.uuid4())}
+        self.products[product['id']] = product
+        return product
+
+    def _new_file(self, location):
+        file_id = str(uuid.uuid4())
+        file_name = Path(urlparse(location).path).name or f'{file_id}.jpg'
+        file = {
+            'type': 'file',
+            'id': file_id,
+            'file_name': file_name,
+            # Картинки отдает сама заглушка, чтобы бенчмарк не ходил во внешнюю сеть
+            'link': {'href': f'/images/{file_id}.jpg'},
+        }
+        self.files[file_id] = file
+        return file
+
+    def _new_entry(self, flow_slug, data):
+        entry = {'type': 'entry', **data, 'id': str(uuid.uuid4())}
+        self.entries.setdefault(flow_slug, {})[entry['id']] = entry
+        return entry
+
+    def _page(self, records, query):
+        limit = int(query.get('page[limit]', ['100'])[0])
+        offset = int(query.get('page[offset]', ['0'])[0])
+        page = records[offset:offset + limit]
+        has_next = offset + limit < len(records)
+
+        return 200, {
+            'data': page,
+            'links': {'next': f'?page[offset]={offset + limit}&page[limit]={limit}' if has_next else None},
+            'meta': {
+                'page': {'limit': limit, 'offset': offset, 'total': (len(records) + limit - 1) // limit},
+                'results': {'total': len(records)},
+            },
+        }
+
+    def _file_view(self, file):
+        return {**file, 'link': {'href': f'{self.base_url}{file["link"]["href"]}'}}
+
+    def _cart_items(self, cart_id):
+        items = []
+        for item in self.carts.get(cart_id, {}).values():
+            product = self.products[item['product_id']]
+            unit = product['price'][0]['amount']
+            value = unit * item['quantity']
+            items.append({
+                **item,
+                'type': 'cart_item',
+                'name': product['name'],
+                'meta': {'display_price': {'with_tax': {
+                    'unit': {'amount': unit, 'formatted': format_price(unit)},
+                    'value': {'amount': value, 'formatted': format_price(value)},
+                }}},
+            })
+        return items
+
+    def _cart_response(self, cart_id):
+        items = self._cart_items(cart_id)
+        total = sum(item['meta']['display_price']['with_tax']['value']['amount'] for item in items)
+        return {
+            'data': items,
+            'meta': {'display_price': {'with_tax': {'amount': total, 'formatted': format_price(total)}}},
+        }
+
+    def create_token(self, params, query, body):
+        return 200, {
+            'access_token': uuid.uuid4().hex,
+            'token_type': 'Bearer',
+            'expires_in': TOKEN_LIFETIME,
+            'expires': int(time.time()) + TOKEN_LIFETIME,
+        }
+
+    def list_products(self, params, query, body):
+        products = list(self.products.values())
+        match = re.fullmatch(r'eq\(sku,(.*)\)', query.get('filter', [''])[0])
+        if match:
+            products = [product for product in products if product.get('sku') == match.group(1)]
+        return self._page(products, query)
+
+    def create_product(self, params, query, body):
+        data = dict(body['data'])
+        data.pop('type', None)
+        return 201, {'data': self._new_product(data)}
+
+    def get_product(self, params, query, body):
+        product = self.products.get(params['product_id'])
+        return (200, {'data': product}) if product else (404, {'errors': [{'title': 'Not Found'}]})
+
+    def delete_product(self, params, query, body):
+        self.products.pop(params['product_id'], None)
+        return 204, None
+
+    def set_main_image(self, params, query, body):
+        product = self.products.get(params['product_id'])
+        if product is None:
+            return 404, {'errors': [{'title': 'Not Found'}]}
+        product['relationships'] = {'main_image': {'data': {'type': 'main_image', 'id': body['data']['id']}}}
+        return 200, {'data': body['data']}
+
+    def list_files(self, params, query, body):
+        return self._page([self._file_view(file) for file in self.files.values()], query)
+
+    def create_file(self, params, query, body):
+        match = re.search(rb'name="file_location"\r\n\r\n(.*?)\r\n', body or b'')
+        location = match.group(1).decode() if match else ''
+        return 201, {'data': self._file_view(self._new_file(location))}
+
+    def get_file(self, params, query, body):
+        file = self.files.get(params['file_id'])
+        return (200, {'data': self._file_view(file)}) if file else (404, {'errors': [{'title': 'Not Found'}]})
+
+    def delete_file(self, params, query, body):
+        self.files.pop(params['file_id'], None)
+        return 204, None
+
+    def get_cart(self, params, query, body):
+        cart = self._cart_response(params['cart_id'])
+        response = {'data': {'id': params['cart_id'], 'type': 'cart', 'meta': cart['meta']}}
+        if 'items' in query.get('include', [''])[0].split(','):
+            response['included'] = {'items': cart['data']}
+        return 200, response
+
+    def delete_cart(self, params, query, body):
+        self.carts.pop(params['cart_id'], None)
+        return 204, None
+
+    def get_cart_items(self, params, query, body):
+        return 200, self._cart_response(params['cart_id'])
+
+    def add_cart_item(self, params, query, body):
+        product_id = body['data']['id']
+        if product_id not in self.products:
+            return 404, {'errors': [{'title': 'Product not found'}]}
+
+        cart = self.carts.setdefault(params['cart_id'], {})
+        item = next((item for item in cart.values() if item['product_id'] == product_id), None)
+        if item is None:
+            item = {'id': str(uuid.uuid4()), 'product_id': product_id, 'quantity': 0}
+            cart[item['id']] = item
+        item['quantity'] += body['data']['quantity']
+
+        return 201, self._cart_response(params['cart_id'])
+
+    def update_cart_item(self, params, query, body):
+        item = self.carts.get(params['cart_id'], {}).get(params['item_id'])
+        if item is None:
+            return 404, {'errors': [{'title': 'Item not found'}]}
+        item['quantity'] = body['data']['quantity']
+        return 200, self._cart_response(params['cart_id'])
+
+    def delete_cart_item(self, params, query, body):
+        self.carts.get(params['cart_id'], {}).pop(params['item_id'], None)
+        return 200, self._cart_response(params['cart_id'])
+
+    def list_customers(self, params, query, body):
+        customers = list(self.customers.values())
+        match = re.fullmatch(r'eq\(email,(.*)\)', query.get('filter', [''])[0])
+        if match:
+            customers = [customer for customer in customers if customer.get('email') == match.group(1)]
+        return self._page(customers, query)
+
+    def create_customer(self, params, query, body):
+        customer = {**body['data'], 'id': str(uuid.uuid4())}
+        self.customers[customer['id']] = customer
+        return 201, {'data': customer}
+
+    def update_customer(self, params, query, body):
+        customer = self.customers.get(params['customer_id'])
+        if customer is None:
+            return 404, {'errors': [{'title': 'Not Found'}]}
+        customer.update(body['data'])
+        return 200, {'data': customer}
+
+    def list_flows(self, params, query, body):
+        return self._page(list(self.flows.values()), query)
+
+    def create_flow(self, params, query, body):
+        slug = body['data']['slug']
+        if slug in self.flows:
+            return 422, {'errors': [{'title': 'Duplicate slug'}]}
+        flow = {**body['data'], 'id': str(uuid.uuid4())}
+        self.flows[slug] = flow
+        return 201, {'data': flow}
+
+    def delete_flow(self, params, query, body):
+        for slug, flow in list(self.flows.items()):
+            if flow['id'] == params['flow_id']:
+                del self.flows[slug]
+                self.entries.pop(slug, None)
+        return 204, None
+
+    def create_field(self, params, query, body):
+        field = {**body['data'], 'id': str(uuid.uuid4())}
+        self.fields[field['id']] = field
+        return 201, {'data': field}
+
+    def list_entries(self, params, query, body):
+        return self._page(list(self.entries.get(params['flow_slug'], {}).values()), query)
+
+    def create_entry(self, params, query, body):
+        data = dict(body['data'])
+        data.pop('type', None)
+        return 201, {'data': self._new_entry(params['flow_slug'], data)}
+
+    def get_entry(self, params, query, body):
+        entry = self.entries.get(params['flow_slug'], {}).get(params['entry_id'])
+        return (200, {'data': entry}) if entry else (404, {'errors': [{'title': 'Not Found'}]})
+
+    def get_image(self, params, query, body):
+        return 200, FAKE_IMAGE
+
+    def dispatch(self, method, path, query, body):
+        for route_method, pattern, label, handler in self._routes:
+            match = pattern.match(path)
+            if route_method == method and match:
+                with self._lock:
+                    endpoint = f'{method} {label}'
+                    self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+                    return handler(match.groupdict(), query, body)
+
+        return 404, {'errors': [{'title': f'No route for {method} {path}'}]}
+
+    def stats(self):
+        with self._lock:
+            return dict(self.requests)
+
+    def reset_stats(self):
+        with self._lock:
+            self.requests = {}
+
+    def _create_request_handler(self):
+        stub = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def _reply(self, status, payload, headers=None):
+                if isinstance(payload, bytes):
+                    body, content_type = payload, 'image/jpeg'
+                elif payload is None:
+                    body, content_type = b'', 'application/json'
+                else:
+                    body, content_type = json.dumps(payload, ensure_ascii=False).encode(), 'application/json'
+
+                # Как и Moltin, отдаём ETag и отвечаем 304 на If-None-Match с тем же значением
+                if self.command == 'GET' and status == 200 and self.path != '/__stats':
+                    etag = f'"{hashlib.sha1(body).hexdigest()[:16]}"'
+                    headers = {**(headers or {}), 'ETag': etag}
+                    if self.headers.get('If-None-Match') == etag:
+                        status, body = 304, b''
+
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _handle(self):
+                length = int(self.headers.get('Content-Length', 0))
+                raw_body = self.rfile.read(length) if length else b''
+                url = urlparse(self.path)
+
+                if url.path == '/__stats':
+                    if self.command == 'DELETE':
+                        stub.reset_stats()
+                    self._reply(200, stub.stats())
+                    return
+
+                delay = stub.latency_ms + random.uniform(-stub.jitter_ms, stub.jitter_ms)
+                if delay > 0:
+                    time.sleep(delay / 1000)
+
+                if random.random() < stub.error_rate:
+                    self._reply(503, {'errors': [{'title': 'Injected error'}]}, {'Retry-After': '0'})
+                    return
+
+                body = raw_body
+                if raw_body and self.headers.get('Content-Type', '').startswith('application/json'):
+                    body = json.loads(raw_body)
+
+                status, payload = stub.dispatch(self.command, url.path, parse_qs(url.query), body)
+                self._reply(status, payload)
+
+            do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        return RequestHandler
+
+    def start(self, host='127.0.0.1', port=DEFAULT_PORT):
+        self._server = ThreadingHTTPServer((host, port), self._create_request_handler())
+        self._server.daemon_threads = True
+        self.base_url = f'http://{host}:{self._server.server_address[1]}'
+
+        thread = threading.Thread(target=self._server.serve_forever, name='moltin-stub', daemon=True)
+        thread.start()
+
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='''
+        Локальная заглушка API Moltin для проверки производительности бота без обращения к api.moltin.com.
+        Укажите боту MOTLIN_API_URL=http://127.0.0.1:<порт>.
+        '''
+    )
+    parser.add_argument('--host', default='127.0.0.1', help='адрес для прослушивания')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='порт')
+    parser.add_argument('--latency-ms', type=float, default=0, help='задержка каждого ответа, мс')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='случайный разброс задержки, мс')
+    parser.add_argument('--error-rate', type=float, default=0, help='доля ответов 503, от 0 до 1')
+
+    return parser
+
+
+if __name__ == '__main__':
+    args = create_parser().parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    stub = MoltinStub(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate)
+    stub.start(args.host, args.port)
+    logger.info(f'Заглушка Moltin запущена на {stub.base_url}')
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        stub.stop()
@@ -0,0 +1,36 @@
+from state_store import StateStore, DEFAULT_STATE_PATH
+
+
+def get_main_image_id(product):
+    return product['relationships']['main_image']['data']['id']
+
+
+class PhotoCache:
+    # product_id -> file_id фото, уже загруженного в Telegram
+
+    def __init__(self, store):
+        self.store = store
+
+    def get(self, product):
+        entry = self.store.get(product['id'])
+        if entry and entry['image_id'] == get_main_image_id(product):
+            return entry['file_id']
+
+    def put(self, product, message):
+        self.store[product['id']] = {
+            'image_id': get_main_image_id(product),
+            'file_id': message.photo[-1].file_id,
+        }
+
+    def discard(self, product):
+        self.store[product['id']] = None
+
+
+photo_cache = PhotoCache(StateStore(table='photo_file_ids', max_cached=1000))
+
+
+def configure_photo_cache(path=DEFAULT_STATE_PATH):
+    photo_cache.store.path = path
+    photo_cache.store.start()
+
+    return photo_cache
@@ -1,15 +1,12 @@
-import os
-import shelve
 import logging
+import secrets
+from functools import partial
 import requests
 from textwrap import dedent
-from datetime import datetime
 from environs import Env
-from geopy.distance import distance
-from geopy import Yandex
 from email_validate import validate
-from urllib.parse import unquote, urlparse
 from telegram import (
+    Update,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     KeyboardButton,
@@ -17,82 +14,78 @@ from telegram import (
     ReplyKeyboardRemove,
     LabeledPrice
 )
+from telegram.error import BadRequest
 from telegram.ext import Filters, Updater
 from telegram.ext import CallbackQueryHandler, CommandHandler, MessageHandler, PreCheckoutQueryHandler
 
 from shop_api import (
-    fetch_products, get_product_by_id, client_credentials_access_token, take_product_image_description,
-    add_product_to_cart, delete_item_from_cart, get_cart_items, get_cart, update_or_create_customer, fetch_entries
+    delete_item_from_cart, iter_entries,
+    configure_session_from_env, get_mirrored_cart_items, get_cart_view, DEFAULT_POOL_SIZE
 )
+import shop_api_async
+from cart_mirror import cart_mirror, DEFAULT_MAX_AGE as CART_MAX_AGE
+from chat_dispatcher import (
+    chat_dispatcher, configure_chat_dispatcher, DEFAULT_WORKERS as DEFAULT_CHAT_WORKERS, DEFAULT_MAX_PENDING
+)
+from cart_buffer import cart_buffer, configure_cart_buffer, DEFAULT_WINDOW as CART_BUFFER_WINDOW
+from catalog import catalog, configure_catalog, DEFAULT_CATALOG_TTL
+from menu_pages import menu_pages
+from pizzeria_directory import PizzeriaDirectory, DEFAULT_REFRESH_INTERVAL
+from delivery_zones import DeliveryZones, DEFAULT_TIERS_PATH
+from state_store import (
+    state_store, configure_state_store, DEFAULT_STATE_PATH, DEFAULT_FLUSH_INTERVAL, DEFAULT_MAX_CACHED
+)
+from photo_cache import photo_cache, configure_photo_cache
+from image_store import (
+    image_store, configure_image_store,
+    DEFAULT_IMAGES_DIR, DEFAULT_MAX_BYTES, DEFAULT_MAX_SIDE, DEFAULT_PREWARM_INTERVAL
+)
+from durable_jobs import durable_jobs, configure_durable_jobs, DEFAULT_WORKERS as DEFAULT_JOB_WORKERS
+from customer_sync import customer_sync, configure_customer_sync
+from token_manager import TokenManager, DEFAULT_REFRESH_MARGIN
+from webhook import (
+    WebhookServer, wait_for_stop_signal, DEFAULT_LISTEN, DEFAULT_PORT, DEFAULT_PATH, DEFAULT_QUEUE_SIZE, DEFAULT_WORKERS
+)
+from metrics import registry, start_metrics_server, DEFAULT_METRICS_LISTEN
+from telegram_request import create_bot, DEFAULT_CON_POOL_SIZE
+from telegram_scheduler import (
+    OutboundScheduler, outbound_priority, BULK,
+    DEFAULT_GLOBAL_RATE, DEFAULT_CHAT_RATE, DEFAULT_GROUP_RATE
+)
+from geocoder import geocoder, configure_geocoder, DEFAULT_MEMORY_SIZE, DEFAULT_NEGATIVE_TTL
 
 
 logger = logging.getLogger(__name__)
 
-IMAGES = 'images'
-MENU_STEP = 7
-
-
-def fetch_coordinates(apikey, address):
-
-    yandex_geocoder = Yandex(apikey)
-    try:
-        location = yandex_geocoder.geocode(address)
-    except requests.exceptions.HTTPError:
-        return None
-
-    if location:
-        lat = location.latitude
-        lon = location.longitude
+COURIERS_CHAT_ID = -1001896820954
+FEEDBACK_DELAY = 60
 
-        return lat, lon
+STATE_SECONDS = registry.histogram('bot_state_duration_seconds', 'Время обработки обновления по состояниям', ['state'])
+STATE_ERRORS = registry.counter('bot_state_errors_total', 'Ошибки обработчиков по состояниям', ['state'])
 
 
-def download_image(image_url, image_name):
-    response = requests.get(image_url)
-    if response.ok:
-        with open(image_name, 'wb') as file:
-            file.write(response.content)
+def count_cart_positions(access_token, chat_id):
+    items = get_mirrored_cart_items(access_token, chat_id)
 
-    return response.ok
+    return cart_buffer.count_positions(chat_id, items)
 
 
 def build_main_menu(access_token, chat_id, start):
 
-    with shelve.open('state') as db:
-        db[f'{str(chat_id)}_start'] = start
+    state_store[f'{chat_id}_start'] = start
 
-    products = fetch_products(access_token)
+    keyboard = list(menu_pages.get_page(access_token, start))
 
-    keyboard = []
-    for product in products[start:start + MENU_STEP]:
-        keyboard.append([InlineKeyboardButton(product['name'], callback_data=product['id'])])
-
-    keyboard.append(
-            [
-                InlineKeyboardButton(' << ', callback_data='previous'),
-                InlineKeyboardButton(' >> ', callback_data='next')
-            ],
-    )
-
-    items = get_cart_items(access_token, chat_id)
-    if items:
-        keyboard.append([InlineKeyboardButton(f'Корзина ({len(items)} поз.)', callback_data='Корзина')])
+    positions = count_cart_positions(access_token, chat_id)
+    if positions:
+        keyboard.append([InlineKeyboardButton(f'Корзина ({positions} поз.)', callback_data='Корзина')])
 
     return keyboard
 
 
 def menu_pagination(access_token, query, chat_id):
-    products = fetch_products(access_token)
-
-    with shelve.open('state') as db:
-        old_start = db[f'{str(chat_id)}_start']
-
-    if query.data == 'next':
-        new_start = old_start if (old_start + MENU_STEP) > len(products) else old_start + MENU_STEP
-    else:
-        new_start = 0 if (old_start - MENU_STEP) < 0 else old_start - MENU_STEP
-    with shelve.open('state') as db:
-        db[f'{str(chat_id)}_start'] = new_start
+    old_start = state_store[f'{chat_id}_start']
+    new_start = menu_pages.next_start(access_token, old_start, query.data)
 
     if old_start == new_start:
         if new_start:
@@ -108,14 +101,61 @@ def menu_pagination(access_token, query, chat_id):
 def build_product_menu(access_token, chat_id, product_id):
     keyboard = [[]]
     keyboard.append([InlineKeyboardButton('Добавить в корзину', callback_data=product_id)])
-    items = get_cart_items(access_token, chat_id)
-    if items:
-        keyboard.append([InlineKeyboardButton(f'Корзина ({len(items)} поз.)', callback_data='Корзина')])
+    positions = count_cart_positions(access_token, chat_id)
+    if positions:
+        keyboard.append([InlineKeyboardButton(f'Корзина ({positions} поз.)', callback_data='Корзина')])
     keyboard.append([InlineKeyboardButton('Назад', callback_data='Назад')])
 
     return keyboard
 
 
+def send_product_photo(context, access_token, chat_id, product, caption, reply_markup, image_url=None):
+    photo_file_id = photo_cache.get(product)
+    if photo_file_id:
+        try:
+            return context.bot.send_photo(
+                chat_id=chat_id,
+                photo=photo_file_id,
+                caption=caption,
+                reply_markup=reply_markup,
+            )
+        except BadRequest as err:
+            logger.warning(f'Telegram не принял file_id для {product["id"]}: {err}')
+            photo_cache.discard(product)
+
+    if image_url is None:
+        image_url = image_store.get_image_url(access_token, product)
+    path = image_store.get_path(image_url)
+    photo = None
+    if path is not None:
+        try:
+            photo = open(path, 'rb')
+        except FileNotFoundError:
+            # Файл успели удалить при соблюдении лимита каталога
+            pass
+
+    if photo is None:
+        # Картинка ещё не скачана: Telegram заберёт её по ссылке
+        image_store.schedule(image_url)
+        message = context.bot.send_photo(
+            chat_id=chat_id,
+            photo=image_url,
+            caption=caption,
+            reply_markup=reply_markup,
+        )
+    else:
+        with photo:
+            message = context.bot.send_photo(
+                chat_id=chat_id,
+                photo=photo,
+                caption=caption,
+                reply_markup=reply_markup,
+            )
+    photo_cache.put(product, message)
+
+    return message
+
+
 def start(update, context):
     access_token = update_token(context)
 
@@ -147,16 +187,13 @@ def product_detail(update, context):
     product_id = query.data
     context.user_data['product_id'] = product_id
 
-    product = get_product_by_id(access_token, product_id)
-    image = take_product_image_description(access_token, product)
+    product = catalog.get_product(access_token, product_id)
 
-    image_url = image['url']
-    image_filename = os.path.basename(unquote(urlparse(image_url).path))
-    path = os.path.join(IMAGES, image_filename)
-    if not os.path.exists(path):
-        download_image(image_url, path)
-
-    keyboard = build_product_menu(access_token, chat_id, product_id)
+    # Позиции корзины и ссылка на картинку запрашиваются параллельно
+    calls = [partial(build_product_menu, access_token, chat_id, product_id)]
+    if photo_cache.get(product) is None:
+        calls.append(partial(image_store.get_image_url, access_token, product))
+    keyboard, *image_urls = shop_api_async.gather(*calls)
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     text = dedent(
@@ -171,12 +208,7 @@ def product_detail(update, context):
         '''
     )
 
-    context.bot.send_photo(
-        chat_id=query.message.chat_id,
-        photo=open(path, 'rb'),
-        caption=text,
-        reply_markup=reply_markup,
-    )
+    send_product_photo(context, access_token, chat_id, product, text, reply_markup, *image_urls)
 
     context.bot.delete_message(
         chat_id=query.message.chat_id,
@@ -218,13 +250,18 @@ def product_order(update, context):
     else:
         product_id = query.data
         amount = 1
-        add_product_to_cart(access_token, chat_id, product_id, amount)
+        # Запись в корзину откладывается, чтобы склеить быстрые повторные нажатия
+        positions = count_cart_positions(access_token, chat_id)
+        cart_buffer.add(chat_id, product_id, amount)
         query.answer('Товар добавлен в корзину.')
-        keyboard = build_product_menu(access_token, chat_id, product_id)
-        reply_markup = InlineKeyboardMarkup(keyboard)
 
-        query.edit_message_reply_markup(
-            reply_markup=reply_markup)
+        # Telegram отклоняет правку, которая не меняет клавиатуру
+        if count_cart_positions(access_token, chat_id) != positions:
+            keyboard = build_product_menu(access_token, chat_id, product_id)
+            reply_markup = InlineKeyboardMarkup(keyboard)
+
+            query.edit_message_reply_markup(
+                reply_markup=reply_markup)
 
         return 'HANDLE_DESCRIPTION'
 
@@ -237,23 +274,20 @@ def display_cart(update, context):
     message_id = query.message.message_id
     text = 'Ваша корзина: \n\n'
 
-    cart = get_cart(access_token, chat_id)
-    items = get_cart_items(access_token, chat_id)
+    cart_buffer.flush(chat_id, access_token)
+    cart = get_cart_view(access_token, chat_id)
 
-    for item in items:
-        price = item['meta']['display_price']['with_tax']['unit']['formatted']
-        summa = item['meta']['display_price']['with_tax']['value']['formatted']
-        text += f'{item["name"]}\n{item["quantity"]} шт. по цене: {price} на сумму: {summa}\n\n'
+    for line in cart.lines:
+        text += f'{line.name}\n{line.quantity} шт. по цене: {line.unit_price} на сумму: {line.value}\n\n'
 
-    total = cart['meta']['display_price']['with_tax']['formatted']
-    text += f'Общая сумму заказа: {total}'
+    text += f'Общая сумму заказа: {cart.total}'
 
     keyboard = []
-    if items:
+    if cart:
         keyboard.append([InlineKeyboardButton('Оформить заказ', callback_data='Оформить')])
-    for item in items:
+    for line in cart.lines:
         keyboard.append(
-            [InlineKeyboardButton(f'Убрать из корзины {item["name"]}', callback_data=item['id'])]
+            [InlineKeyboardButton(f'Убрать из корзины {line.name}', callback_data=line.id)]
         )
     keyboard.append([InlineKeyboardButton('В меню', callback_data='В меню')])
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -310,6 +344,7 @@ def show_cart(update, context):
 
     else:
         item_id = query.data
+        cart_buffer.flush(chat_id, access_token)
         delete_item_from_cart(access_token, chat_id, item_id)
 
     display_cart(update, context)
@@ -337,14 +372,13 @@ def fetch_email(update, context):
 
 
 def fetch_address(update, context):
-    api_key = context.bot_data['yandex_api_key']
     access_token = update_token(context)
 
     if not update.message.text:
         address_location = (update.message.location['latitude'], update.message.location['longitude'])
     else:
         address_text = update.message.text
-        address_location = fetch_coordinates(api_key, address_text)
+        address_location = geocoder.fetch_coordinates(address_text)
 
     if not address_location:
         keyboard = [[KeyboardButton('Отправить местоположение', request_location=True)]]
@@ -361,18 +395,13 @@ def fetch_address(update, context):
         return 'HANDLE_ADDRESS'
 
     else:
-        pizzerias = fetch_entries(access_token, 'pizzerias')
-
-        distances = [
-            (
-                pizzeria,
-                round(distance(address_location, (pizzeria['latitude'], pizzeria['longitude'])).km, 1)
-            ) for pizzeria in pizzerias
-        ]
-
-        nearest_pizzeria, nearest_pizzeria_distance = min(distances, key=lambda item: item[1])
-        nearest_pizzeria_address = nearest_pizzeria['address']
-        if nearest_pizzeria_distance <= 0.5:
+        quote = context.bot_data['delivery_zones'].quote(address_location)
+        nearest_pizzeria = quote.pizzeria
+        nearest_pizzeria_distance = round(quote.distance_km, 1)
+        nearest_pizzeria_address = nearest_pizzeria.address
+        delivery_price = quote.price
+        delivery_option = quote.is_deliverable
+        if delivery_price == 0:
             text = dedent(
                 f'''
                 Можете забрать пиццу из нашей пиццерии неподалеку?
@@ -383,32 +412,26 @@ def fetch_address(update, context):
                 А можем и бесплатно доставить - нам не сложно.
                 '''
             )
-            delivery_option = True
-            delivery_price = 0
 
-        elif nearest_pizzeria_distance <= 5.0:
+        elif delivery_option and not quote.is_last_tier:
             text = dedent(
                 f'''
                 О, Вы не так далеко. Ближайшая пиццерия находится по адресу: {nearest_pizzeria_address}
-                Доставка будет стоить 100 рублей.
+                Доставка будет стоить {delivery_price} рублей.
 
                 Доставляем или самовывоз?
                 '''
             )
-            delivery_option = True
-            delivery_price = 100
 
-        elif nearest_pizzeria_distance <= 20.0:
+        elif delivery_option:
             text = dedent(
                 f'''
                 Ближайшая к Вам пиццерия довольно далеко: 
-                {nearest_pizzeria_distance} км. Доставка будет 300 рублей.
+                {nearest_pizzeria_distance} км. Доставка будет {delivery_price} рублей.
                 
                 Доставляем или самовывоз?
                 '''
             )
-            delivery_option = True
-            delivery_price = 300
 
         else:
             text = dedent(f'''
@@ -417,10 +440,8 @@ def fetch_address(update, context):
                 Ближайшая до Вас пиццерия в {nearest_pizzeria_distance} км.
                 Можете забрать сами, если сможете 😁
             ''')
-            delivery_price = None
-            delivery_option = False
 
-        context.user_data['pizzeria'] = nearest_pizzeria
+        context.user_data['pizzeria_id'] = nearest_pizzeria.id
         context.user_data['delivery_price'] = delivery_price
         context.user_data['delivery_address'] = address_location
 
@@ -444,7 +465,7 @@ def fetch_address(update, context):
             'longitude': float(user['delivery_address'][0]),
             'latitude': float(user['delivery_address'][1])
         }
-        update_or_create_customer(access_token, customer)
+        customer_sync.submit(customer)
 
         return 'HANDLE_PAYMENT'
 
@@ -456,7 +477,11 @@ def process_delivery(update, context):
     chat_id = query.message.chat_id
 
     if query.data == 'Самовывоз':
-        pizzeria_address = context.user_data['pizzeria']['address']
+        pizzeria = context.bot_data['pizzeria_directory'].get(context.user_data['pizzeria_id'])
+        if pizzeria is None:
+            # Пиццерию убрали из справочника, пока пользователь оформлял заказ
+            pizzeria = context.bot_data['delivery_zones'].quote(context.user_data['delivery_address']).pizzeria
+        pizzeria_address = pizzeria.address
         text = dedent(
             f'''
             Ваша пицца будет ждать Вас по адресу:
@@ -484,26 +509,23 @@ def process_delivery(update, context):
         return 'HANDLE_MENU'
 
     else:
-        cart = get_cart(access_token, chat_id)
-        items = get_cart_items(access_token, chat_id)
+        cart_buffer.flush(chat_id, access_token)
+        cart = get_cart_view(access_token, chat_id)
         display_text = ''
-        for item in items:
-            price = item['meta']['display_price']['with_tax']['unit']['formatted']
-            summa = item['meta']['display_price']['with_tax']['value']['formatted']
+        for line in cart.lines:
             display_text += dedent(
                 f'''
-                {item["name"]}
-                {item["quantity"]} шт. по цене: {price} на сумму: {summa}
+                {line.name}
+                {line.quantity} шт. по цене: {line.unit_price} на сумму: {line.value}
                 
                 '''
             )
 
-        cart_summa = cart['meta']['display_price']['with_tax']['amount']
+        cart_summa = cart.total_amount
 
         delivery_price = context.user_data['delivery_price']
         total = cart_summa + delivery_price
 
-        pizzeria = context.user_data['pizzeria']
         lat, lon = context.user_data['delivery_address']
 
         # Уведомления пользователя
@@ -543,26 +565,38 @@ def process_delivery(update, context):
             Итого: {total} руб.
             '''
         )
-        context.bot.send_message(
-            chat_id=-1001896820954,  # тестовая отправка в группу (chat_id=pizzeria['telegram_id'])
-            text=text,
+        # Уведомления курьеру и напоминание - фоновыми заданиями
+        order_key = f'{chat_id}:{query.id}'
+        durable_jobs.enqueue(
+            'courier_notification',
+            {
+                'order_key': order_key,
+                'chat_id': COURIERS_CHAT_ID,  # тестовая отправка в группу (chat_id=pizzeria['telegram_id'])
+                'text': text,
+                'location': [lat, lon],
+            },
+            key=f'courier_notification:{order_key}'
         )
-
-        context.bot.send_location(
-            chat_id=-1001896820954,
-            latitude=lat,
-            longitude=lon
+        durable_jobs.enqueue(
+            'feedback', {'chat_id': chat_id}, key=f'feedback:{order_key}', delay=FEEDBACK_DELAY
         )
         context.user_data['total'] = total
-        context.job_queue.run_once(feedback, 60, context=chat_id)
 
         return 'START_PAYMENT'
 
 
-def feedback(context):
+def notify_cart_failure(bot, chat_id):
+    # Запись в корзину не удалась после ответа пользователю
+    bot.send_message(
+        chat_id=chat_id,
+        text='Не удалось добавить товар в корзину. Попробуйте еще раз.'
+    )
 
-    context.bot.send_message(
-        chat_id=context.job.context,
+
+def send_feedback(bot, chat_id):
+
+    bot.send_message(
+        chat_id=chat_id,
         text=dedent(
             '''
             (Уведомление для feedback как бы через час)
@@ -575,6 +609,33 @@ def feedback(context):
     )
 
 
+def register_order_jobs(jobs, bot):
+
+    def notify_courier(payload):
+        bot.send_message(chat_id=payload['chat_id'], text=payload['text'])
+        # Точка доставки - отдельным заданием, чтобы повтор не дублировал текст
+        jobs.enqueue(
+            'courier_location',
+            {'chat_id': payload['chat_id'], 'location': payload['location']},
+            key=f'courier_location:{payload["order_key"]}'
+        )
+
+    def send_location(payload):
+        latitude, longitude = payload['location']
+        bot.send_location(chat_id=payload['chat_id'], latitude=latitude, longitude=longitude)
+
+    def as_bulk(handler):
+        # Уведомления уступают очередь ответам пользователям
+        def run(payload):
+            with outbound_priority(BULK):
+                handler(payload)
+        return run
+
+    jobs.register('courier_notification', as_bulk(notify_courier))
+    jobs.register('courier_location', as_bulk(send_location))
+    jobs.register('feedback', as_bulk(lambda payload: send_feedback(bot, payload['chat_id'])))
+
+
 def start_payment_callback(update, context):
 
     query = update.callback_query
@@ -653,6 +714,19 @@ def cancel(update, context):
     )
 
 
+STATES_FUNCTIONS = {
+    'START': start,
+    'HANDLE_MENU': product_detail,
+    'HANDLE_DESCRIPTION': product_order,
+    'HANDLE_CART': show_cart,
+    'HANDLE_ADDRESS': fetch_address,
+    'HANDLE_EMAIL': fetch_email,
+    'HANDLE_PAYMENT': process_delivery,
+    'CANCEL': cancel,
+    'START_PAYMENT': start_payment_callback
+}
+
+
 def handle_users_reply(update, context):
     if update.message:
         user_reply = update.message.text
@@ -662,50 +736,44 @@ def handle_users_reply(update, context):
         chat_id = update.callback_query.message.chat_id
     else:
         return
+
+    # Состояние читается и пишется в потоке чата
+    chat_dispatcher.submit(chat_id, handle_chat_reply, update, context, chat_id, user_reply)
+
+
+def handle_chat_reply(update, context, chat_id, user_reply):
     if user_reply == '/start':
         user_state = 'START'
     elif user_reply == '/cancel':
         user_state = 'CANCEL'
 
     else:
-        with shelve.open('state') as db:
-            user_state = db[str(chat_id)]
-
-    states_functions = {
-        'START': start,
-        'HANDLE_MENU': product_detail,
-        'HANDLE_DESCRIPTION': product_order,
-        'HANDLE_CART': show_cart,
-        'HANDLE_ADDRESS': fetch_address,
-        'HANDLE_EMAIL': fetch_email,
-        'HANDLE_PAYMENT': process_delivery,
-        'CANCEL': cancel,
-        'START_PAYMENT': start_payment_callback
-    }
-    state_handler = states_functions[user_state]
+        user_state = state_store[chat_id]
+
+    state_handler = STATES_FUNCTIONS[user_state]
 
     try:
-        next_state = state_handler(update, context)
-        with shelve.open('state') as db:
-            db[str(chat_id)] = next_state
+        with STATE_SECONDS.time(state=user_state):
+            next_state = state_handler(update, context)
+        state_store[chat_id] = next_state
     except Exception as err:
+        STATE_ERRORS.inc(state=user_state)
         print(err)
         logger.error(err)
 
 
-def update_token(context):
-    token = context.bot_data['token']
-    now = datetime.timestamp(datetime.now())
+def reconcile_carts_job(context):
+    try:
+        cart_buffer.reconcile(context.bot_data['token_manager'].get_access_token())
+    except requests.exceptions.RequestException as err:
+        logger.warning(f'Не удалось сверить корзины с интернет-магазином: {err}')
 
-    if now > token['expires']:
-        token = client_credentials_access_token(context.bot_data['client_id'], context.bot_data['client_secret'])
-        context.bot_data['token'] = token
 
-    return token['access_token']
+def update_token(context):
+    return context.bot_data['token_manager'].get_access_token()
 
 
 if __name__ == '__main__':
-    os.makedirs(IMAGES, exist_ok=True)
     env = Env()
     env.read_env()
 
@@ -716,26 +784,101 @@ if __name__ == '__main__':
     )
     logger.info('Запущен pizza-bot')
 
+    configure_session_from_env(env)
+    shop_api_async.configure_executor(env.int('MOTLIN_POOL_SIZE', DEFAULT_POOL_SIZE))
+    configure_catalog(ttl=env.int('CATALOG_TTL', DEFAULT_CATALOG_TTL))
+    configure_state_store(
+        path=env.str('STATE_DB_PATH', DEFAULT_STATE_PATH),
+        flush_interval=env.float('STATE_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL),
+        max_cached=env.int('STATE_CACHE_SIZE', DEFAULT_MAX_CACHED)
+    )
+    configure_photo_cache(path=env.str('STATE_DB_PATH', DEFAULT_STATE_PATH))
+    configure_image_store(
+        directory=env.str('IMAGES_DIR', DEFAULT_IMAGES_DIR),
+        max_bytes=env.int('IMAGES_MAX_BYTES', DEFAULT_MAX_BYTES),
+        max_side=env.int('IMAGES_MAX_SIDE', DEFAULT_MAX_SIDE)
+    )
+
     # Получение токена для работы с интернет-магазином
     client_id = env.str('MOTLIN_CLIENT_ID')
     client_secret = env.str('MOTLIN_CLIENT_SECRET')
-    motlin_token = client_credentials_access_token(client_id, client_secret)
+    token_manager = TokenManager(
+        client_id,
+        client_secret,
+        refresh_margin=env.int('MOTLIN_TOKEN_REFRESH_MARGIN', DEFAULT_REFRESH_MARGIN)
+    ).start()
+    configure_durable_jobs(
+        path=env.str('STATE_DB_PATH', DEFAULT_STATE_PATH),
+        workers=env.int('JOB_WORKERS', DEFAULT_JOB_WORKERS)
+    )
+    configure_customer_sync(path=env.str('STATE_DB_PATH', DEFAULT_STATE_PATH)).start(token_manager.get_access_token)
+    configure_cart_buffer(window=env.float('CART_BUFFER_WINDOW', CART_BUFFER_WINDOW))
+    image_store.start(
+        token_manager.get_access_token,
+        interval=env.int('IMAGES_PREWARM_INTERVAL', DEFAULT_PREWARM_INTERVAL)
+    )
 
     yandex_api_key = env.str('YANDEX_GEOCODER_API_KEY')
     payment_provider_token = env.str('PAYMENT_PROVIDER_TOKEN')
+    configure_geocoder(
+        yandex_api_key,
+        path=env.str('STATE_DB_PATH', DEFAULT_STATE_PATH),
+        memory_size=env.int('GEOCODE_CACHE_SIZE', DEFAULT_MEMORY_SIZE),
+        negative_ttl=env.int('GEOCODE_NEGATIVE_TTL', DEFAULT_NEGATIVE_TTL)
+    )
+
+    metrics_port = env.int('METRICS_PORT', None)
+    if metrics_port is not None:
+        start_metrics_server(metrics_port, listen=env.str('METRICS_LISTEN', DEFAULT_METRICS_LISTEN))
+
+    # Обработчики обновлений вызывают Bot API из потоков пула чатов
+    configure_chat_dispatcher(
+        workers=env.int('CHAT_WORKERS', DEFAULT_CHAT_WORKERS),
+        max_pending=env.int('CHAT_MAX_PENDING', DEFAULT_MAX_PENDING)
+    )
 
     token = env.str('TG_TOKEN')
-    updater = Updater(token=token, use_context=True)
+    scheduler = OutboundScheduler(
+        global_rate=env.float('TELEGRAM_GLOBAL_RATE', DEFAULT_GLOBAL_RATE),
+        chat_rate=env.float('TELEGRAM_CHAT_RATE', DEFAULT_CHAT_RATE),
+        group_rate=env.float('TELEGRAM_GROUP_RATE_PER_MINUTE', DEFAULT_GROUP_RATE * 60) / 60
+    )
+    bot = create_bot(
+        token,
+        con_pool_size=max(DEFAULT_CON_POOL_SIZE, chat_dispatcher.workers + 4),
+        scheduler=scheduler
+    )
+    updater = Updater(bot=bot, use_context=True)
+    cart_buffer.start(
+        token_manager.get_access_token,
+        on_failure=lambda cart_id, product_id, amount: notify_cart_failure(bot, cart_id)
+    )
     dispatcher = updater.dispatcher
 
+    register_order_jobs(durable_jobs, updater.bot)
+    durable_jobs.start()
+
     dispatcher.bot_data = {
-        'token': motlin_token,
-        'client_id': client_id,
-        'client_secret': client_secret,
+        'token_manager': token_manager,
         'yandex_api_key': yandex_api_key,
         'payment_provider_token': payment_provider_token
     }
 
+    pizzeria_directory = PizzeriaDirectory(
+        lambda: iter_entries(token_manager.get_access_token(), 'pizzerias', prefetch=True),
+        refresh_interval=env.int('PIZZERIAS_REFRESH_INTERVAL', DEFAULT_REFRESH_INTERVAL)
+    ).start()
+    dispatcher.bot_data['pizzeria_directory'] = pizzeria_directory
+    delivery_zones = DeliveryZones(
+        pizzeria_directory.get_locator,
+        tiers_path=env.str('DELIVERY_TIERS_PATH', DEFAULT_TIERS_PATH)
+    ).start()
+    dispatcher.bot_data['delivery_zones'] = delivery_zones
+
+    cart_mirror.max_age = env.int('CART_MIRROR_MAX_AGE', CART_MAX_AGE)
+    updater.job_queue.run_repeating(reconcile_carts_job, interval=cart_mirror.max_age)
+
+    chat_dispatcher.start()
     dispatcher.add_handler(MessageHandler(Filters.successful_payment, successful_payment_callback))
     dispatcher.add_handler(PreCheckoutQueryHandler(precheckout_callback))
     dispatcher.add_handler(CallbackQueryHandler(handle_users_reply, pass_job_queue=True))
@@ -743,5 +886,45 @@ if __name__ == '__main__':
     dispatcher.add_handler(MessageHandler(Filters.location, handle_users_reply))
     dispatcher.add_handler(CommandHandler('start', handle_users_reply))
 
-    updater.start_polling()
-    updater.idle()
+    webhook_url = env.str('WEBHOOK_URL', None)
+    if webhook_url:
+        # Секрет защищает webhook от поддельных обновлений
+        webhook_secret_token = env.str('WEBHOOK_SECRET_TOKEN', None) or secrets.token_urlsafe(32)
+        webhook_server = WebhookServer(
+            lambda data: dispatcher.process_update(Update.de_json(data, updater.bot)),
+            listen=env.str('WEBHOOK_LISTEN', DEFAULT_LISTEN),
+            port=env.int('WEBHOOK_PORT', DEFAULT_PORT),
+            path=env.str('WEBHOOK_PATH', DEFAULT_PATH),
+            queue_size=env.int('WEBHOOK_QUEUE_SIZE', DEFAULT_QUEUE_SIZE),
+            workers=env.int('WEBHOOK_WORKERS', DEFAULT_WORKERS),
+            secret_token=webhook_secret_token
+        ).start()
+        updater.job_queue.start()
+        updater.bot.set_webhook(
+            url=f'{webhook_url.rstrip("/")}{webhook_server.path}',
+            secret_token=webhook_secret_token
+        )
+
+        wait_for_stop_signal()
+
+        webhook_server.stop()
+        updater.job_queue.stop()
+    else:
+        updater.start_polling()
+        updater.idle()
+
+    chat_dispatcher.stop()
+    cart_buffer.stop()
+    pizzeria_directory.stop()
+    delivery_zones.stop()
+    image_store.stop()
+    durable_jobs.stop()
+    token_manager.stop()
+    state_store.close()
+    photo_cache.store.close()
+    geocoder.store.close()
+    customer_sync.store.close()
+
+    metrics_dump_path = env.str('METRICS_DUMP_PATH', None)
+    if metrics_dump_path:
+        registry.dump(metrics_dump_path)
@@ -0,0 +1,92 @@
+import logging
+import threading
+from typing import NamedTuple
+
+from pizzeria_locator import PizzeriaLocator
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REFRESH_INTERVAL = 600
+
+
+class Pizzeria(NamedTuple):
+    id: str
+    address: str
+    latitude: float
+    longitude: float
+    alias: str = None
+    telegram_id: int = None
+
+    @classmethod
+    def from_entry(cls, entry):
+        return cls(
+            id=entry['id'],
+            address=entry['address'],
+            latitude=float(entry['latitude']),
+            longitude=float(entry['longitude']),
+            alias=entry.get('alias'),
+            telegram_id=entry.get('telegram_id'),
+        )
+
+
+class PizzeriaDirectory:
+    # Справочник пиццерий обновляется в фоне раз в refresh_interval
+
+    def __init__(self, fetch_entries, refresh_interval=DEFAULT_REFRESH_INTERVAL):
+        self.fetch_entries = fetch_entries
+        self.refresh_interval = refresh_interval
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def version(self):
+        return self._snapshot[0] if self._snapshot else 0
+
+    def refresh(self):
+        pizzerias = tuple(sorted(Pizzeria.from_entry(entry) for entry in self.fetch_entries()))
+        with self._lock:
+            if self._snapshot is not None and self._snapshot[2].pizzerias == list(pizzerias):
+                return False
+
+            self._snapshot = (
+                self.version + 1,
+                {pizzeria.id: pizzeria for pizzeria in pizzerias},
+                PizzeriaLocator(pizzerias),
+            )
+        logger.info(f'Справочник пиццерий обновлён до версии {self.version}: {len(pizzerias)} адресов')
+
+        return True
+
+    def _get_snapshot(self):
+        if self._snapshot is None:
+            self.refresh()
+
+        return self._snapshot
+
+    def get(self, pizzeria_id):
+        _, pizzerias, _ = self._get_snapshot()
+        return pizzerias.get(pizzeria_id)
+
+    def get_locator(self):
+        _, _, locator = self._get_snapshot()
+        return locator
+
+    def _run(self):
+        while not self._stop.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception as err:
+                logger.warning(f'Не удалось обновить справочник пиццерий: {err}')
+
+    def start(self):
+        self.refresh()
+        self._thread = threading.Thread(target=self._run, name='pizzeria-directory', daemon=True)
+        self._thread.start()
+
+        return self
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,113 @@
+import heapq
+from math import asin, cos, pi, radians, sin
+
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def to_unit_vector(latitude, longitude):
+    lat = radians(float(latitude))
+    lon = radians(float(longitude))
+
+    return cos(lat) * cos(lon), cos(lat) * sin(lon), sin(lat)
+
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * asin(min(1.0, chord / 2))
+
+
+def km_to_chord(km):
+    return 2 * sin(min(km, EARTH_RADIUS_KM * pi) / (2 * EARTH_RADIUS_KM))
+
+
+def squared_chord(a, b):
+    return (a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2
+
+
+class PizzeriaLocator:
+    # k-d дерево по точкам на единичной сфере
+
+    def __init__(self, pizzerias):
+        self.pizzerias = list(pizzerias)
+        self._points = [
+            to_unit_vector(pizzeria.latitude, pizzeria.longitude)
+            for pizzeria in self.pizzerias
+        ]
+        self._tree = self._build(list(range(len(self._points))), depth=0)
+
+    def __len__(self):
+        return len(self.pizzerias)
+
+    def _build(self, indexes, depth):
+        if not indexes:
+            return None
+
+        axis = depth % 3
+        indexes.sort(key=lambda index: self._points[index][axis])
+        median = len(indexes) // 2
+
+        return (
+            indexes[median],
+            axis,
+            self._build(indexes[:median], depth + 1),
+            self._build(indexes[median + 1:], depth + 1),
+        )
+
+    def distance(self, location, pizzeria):
+        point = to_unit_vector(pizzeria.latitude, pizzeria.longitude)
+        return chord_to_km(squared_chord(to_unit_vector(*location), point) ** 0.5)
+
+    def nearest(self, location, k=1):
+        target = to_unit_vector(*location)
+        best = []  # max-куча по (-квадрат хорды, индекс)
+
+        def search(node):
+            if node is None:
+                return
+            index, axis, left, right = node
+
+            dist = squared_chord(target, self._points[index])
+            if len(best) < k:
+                heapq.heappush(best, (-dist, index))
+            elif dist < -best[0][0]:
+                heapq.heapreplace(best, (-dist, index))
+
+            delta = target[axis] - self._points[index][axis]
+            near, far = (left, right) if delta < 0 else (right, left)
+            search(near)
+            if len(best) < k or delta ** 2 < -best[0][0]:
+                search(far)
+
+        search(self._tree)
+
+        return [
+            (self.pizzerias[index], chord_to_km((-neg_dist) ** 0.5))
+            for neg_dist, index in sorted(best, reverse=True)
+        ]
+
+    def within(self, location, radius_km):
+        target = to_unit_vector(*location)
+        limit = km_to_chord(radius_km) ** 2
+        found = []
+
+        def search(node):
+            if node is None:
+                return
+            index, axis, left, right = node
+
+            dist = squared_chord(target, self._points[index])
+            if dist <= limit:
+                found.append((dist, index))
+
+            delta = target[axis] - self._points[index][axis]
+            near, far = (left, right) if delta < 0 else (right, left)
+            search(near)
+            if delta ** 2 <= limit:
+                search(far)
+
+        search(self._tree)
+
+        return [
+            (self.pizzerias[index], chord_to_km(dist ** 0.5))
+            for dist, index in sorted(found)
+        ]
@@ -1,42 +1,240 @@
+import re
+import time
 import requests
+from dataclasses import dataclass
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from slugify import slugify
 from environs import Env
 
+from cart_mirror import cart_mirror
+from http_cache import ResponseCache, DEFAULT_MAX_BYTES as DEFAULT_CACHE_MAX_BYTES
+from metrics import registry
 
-API_BASE_URL = 'https://api.moltin.com/v2'
+
+API_URL = 'https://api.moltin.com'
+API_BASE_URL = f'{API_URL}/v2'
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 10
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.3
+
+# POST не повторяем: повторное создание товара или позиции в корзине не идемпотентно
+RETRY_METHODS = frozenset(['GET', 'PUT', 'DELETE', 'HEAD', 'OPTIONS'])
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Moltin отдает не больше 100 записей на страницу
+DEFAULT_PAGE_SIZE = 100
+
+REQUEST_SECONDS = registry.histogram(
+    'moltin_request_duration_seconds', 'Время запроса к Moltin вместе с повторами', ['method', 'endpoint']
+)
+RESPONSES = registry.counter(
+    'moltin_responses_total', 'Ответы Moltin по кодам состояния', ['method', 'endpoint', 'status']
+)
+RETRIES = registry.counter('moltin_retries_total', 'Повторные запросы к Moltin', ['method', 'endpoint'])
+
+
+def endpoint_label(url):
+    segments = urlparse(url).path.split('/')
+    return '/'.join(
+        '{id}' if re.search(r'\d', segment) and not re.fullmatch(r'v\d+', segment) else segment
+        for segment in segments
+    )
+
+
+class RateLimitedRetry(Retry):
+    # Повторы urllib3 идут мимо TimeoutHTTPAdapter, поэтому лимит берём здесь
+
+    def __init__(self, *args, rate_limiter=None, **kwargs):
+        self.rate_limiter = rate_limiter
+        super().__init__(*args, **kwargs)
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.rate_limiter = self.rate_limiter
+
+        return retry
+
+    def sleep(self, response=None):
+        super().sleep(response)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+
+    def __init__(self, *args, timeout=DEFAULT_TIMEOUT, rate_limiter=None, cache=None, **kwargs):
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.cache = cache
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if self.cache is None:
+            return self._send(request, **kwargs)
+
+        # Ответ из кэша не расходует лимит запросов и не попадает в moltin_responses_total
+        return self.cache.send(request, lambda request: self._send(request, **kwargs), endpoint_label(request.url))
+
+    def _send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+        labels = {'method': request.method, 'endpoint': endpoint_label(request.url)}
+        started_at = time.perf_counter()
+        try:
+            response = super().send(request, **kwargs)
+        except requests.exceptions.RequestException:
+            RESPONSES.inc(status='error', **labels)
+            raise
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - started_at, **labels)
+
+        RESPONSES.inc(status=response.status_code, **labels)
+        retries = getattr(response.raw, 'retries', None)
+        if retries is not None and retries.history:
+            RETRIES.inc(len(retries.history), **labels)
+
+        return response
+
+
+def create_session(pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                   retries=DEFAULT_RETRIES, backoff_factor=DEFAULT_BACKOFF_FACTOR, rate_limiter=None,
+                   cache_max_bytes=DEFAULT_CACHE_MAX_BYTES):
+    retry = RateLimitedRetry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=RETRY_METHODS,
+        raise_on_status=False,
+        rate_limiter=rate_limiter,
+    )
+    adapter = TimeoutHTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=retry,
+        timeout=timeout,
+        rate_limiter=rate_limiter,
+        cache=ResponseCache(max_bytes=cache_max_bytes) if cache_max_bytes else None,
+    )
+
+    new_session = requests.Session()
+    new_session.mount('https://', adapter)
+    new_session.mount('http://', adapter)
+
+    return new_session
+
+
+def configure_session(**kwargs):
+    global session
+
+    old_session = session
+    session = create_session(**kwargs)
+    old_session.close()
+
+    return session
+
+
+def configure_api_url(api_url=API_URL):
+    global API_URL, API_BASE_URL
+
+    API_URL = api_url.rstrip('/')
+    API_BASE_URL = f'{API_URL}/v2'
+
+
+def configure_session_from_env(env, **kwargs):
+    configure_api_url(env.str('MOTLIN_API_URL', API_URL))
+
+    settings = {
+        'pool_size': env.int('MOTLIN_POOL_SIZE', DEFAULT_POOL_SIZE),
+        'timeout': env.float('MOTLIN_TIMEOUT', DEFAULT_TIMEOUT),
+        'retries': env.int('MOTLIN_RETRIES', DEFAULT_RETRIES),
+        'backoff_factor': env.float('MOTLIN_BACKOFF_FACTOR', DEFAULT_BACKOFF_FACTOR),
+        'cache_max_bytes': env.int('MOTLIN_CACHE_MAX_BYTES', DEFAULT_CACHE_MAX_BYTES),
+    }
+    settings.update(kwargs)
+
+    return configure_session(**settings)
+
+
+session = create_session()
+prefetch_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='moltin-prefetch')
+
+
+def iter_pages(access_token, url, params=None, page_size=DEFAULT_PAGE_SIZE, prefetch=False):
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+    }
+    params = dict(params or {})
+    params['page[limit]'] = page_size
+
+    def fetch_page(offset):
+        response = session.get(url, headers=headers, params={**params, 'page[offset]': offset})
+        response.raise_for_status()
+        return response.json()
+
+    offset = 0
+    page = fetch_page(offset)
+    while True:
+        records = page['data']
+        links = page.get('links')
+        has_next = len(records) >= page_size and (links is None or bool(links.get('next')))
+
+        next_page = None
+        if has_next and prefetch:
+            next_page = prefetch_executor.submit(fetch_page, offset + page_size)
+
+        try:
+            yield from records
+        except GeneratorExit:
+            # Потребитель остановился раньше - заранее запрошенная страница не нужна
+            if next_page is not None:
+                next_page.cancel()
+            raise
+
+        if not has_next:
+            return
+
+        offset += page_size
+        page = next_page.result() if next_page is not None else fetch_page(offset)
 
 
 def client_credentials_access_token(client_id, client_secret):
-    url_api = 'https://api.moltin.com/oauth/access_token'
+    url_api = f'{API_URL}/oauth/access_token'
     data = {
         'client_id': client_id,
         'client_secret': client_secret,
         'grant_type': 'client_credentials'
     }
 
-    response = requests.post(url_api, data=data)
+    response = session.post(url_api, data=data)
     response.raise_for_status()
 
     return response.json()
 
 
-def fetch_products(access_token):
-    url = 'https://api.moltin.com/v2/products'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    products = requests.get(url, headers=headers)
-    products.raise_for_status()
+def iter_products(access_token, page_size=DEFAULT_PAGE_SIZE, prefetch=False):
+    url = f'{API_BASE_URL}/products'
 
-    return products.json()['data']
+    return iter_pages(access_token, url, page_size=page_size, prefetch=prefetch)
+
+
+def fetch_products(access_token):
+    return list(iter_products(access_token, prefetch=True))
 
 
 def get_product_by_id(access_token, product_id):
-    url = f'https://api.moltin.com/v2/products/{product_id}'
+    url = f'{API_BASE_URL}/products/{product_id}'
     headers = {
         'Authorization': f'Bearer {access_token}'
     }
-    products = requests.get(url, headers=headers)
+    products = session.get(url, headers=headers)
     products.raise_for_status()
 
     return products.json()['data']
@@ -45,13 +243,13 @@ def get_product_by_id(access_token, product_id):
 def take_product_image_description(access_token, product) -> dict:
 
     file_id = product['relationships']['main_image']['data']['id']
-    url_api = f'https://api.moltin.com/v2/files/{file_id}'
+    url_api = f'{API_BASE_URL}/files/{file_id}'
 
     headers = {
         'Authorization': f'Bearer {access_token}',
     }
 
-    response = requests.get(url_api, headers=headers)
+    response = session.get(url_api, headers=headers)
     response.raise_for_status()
 
     response_image = response.json()['data']
@@ -65,35 +263,106 @@ def take_product_image_description(access_token, product) -> dict:
 
 
 def get_cart(access_token, cart_id):
-    url_api = f'https://api.moltin.com/v2/carts/{cart_id}'
+    url_api = f'{API_BASE_URL}/carts/{cart_id}'
 
     headers = {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/json',
     }
 
-    response = requests.get(url_api, headers=headers)
+    response = session.get(url_api, headers=headers)
     response.raise_for_status()
 
     return response.json()['data']
 
 
+@dataclass(frozen=True)
+class CartLine:
+    id: str
+    product_id: str
+    name: str
+    quantity: int
+    unit_price: str
+    value: str
+
+    @classmethod
+    def from_item(cls, item):
+        with_tax = item['meta']['display_price']['with_tax']
+        return cls(
+            id=item['id'],
+            product_id=item['product_id'],
+            name=item['name'],
+            quantity=item['quantity'],
+            unit_price=with_tax['unit']['formatted'],
+            value=with_tax['value']['formatted'],
+        )
+
+
+@dataclass(frozen=True)
+class CartView:
+    id: str
+    lines: tuple
+    total: str
+    total_amount: int
+
+    def __bool__(self):
+        return bool(self.lines)
+
+
+def get_cart_view(access_token, cart_id):
+    url_api = f'{API_BASE_URL}/carts/{cart_id}'
+
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+    }
+    params = {
+        'include': 'items',
+    }
+
+    response = session.get(url_api, headers=headers, params=params)
+    response.raise_for_status()
+
+    cart = response.json()
+    items = cart.get('included', {}).get('items', [])
+    cart_mirror.replace(cart_id, items)
+
+    with_tax = cart['data']['meta']['display_price']['with_tax']
+
+    return CartView(
+        id=str(cart_id),
+        lines=tuple(CartLine.from_item(item) for item in items),
+        total=with_tax['formatted'],
+        total_amount=with_tax['amount'],
+    )
+
+
 def delete_cart(access_token, cart_id):
-    url_api = f'https://api.moltin.com/v2/carts/{cart_id}'
+    url_api = f'{API_BASE_URL}/carts/{cart_id}'
 
     headers = {
         'Authorization': f'Bearer {access_token}',
     }
 
-    response = requests.delete(url_api, headers=headers)
+    response = session.delete(url_api, headers=headers)
     response.raise_for_status()
+    cart_mirror.forget(cart_id)
 
     return response
 
 
+def mirror_cart_response(card_id, response):
+    cart_items = response.json()
+    if response.ok and isinstance(cart_items.get('data'), list):
+        cart_mirror.replace(card_id, cart_items['data'])
+    else:
+        cart_mirror.forget(card_id)
+
+    return cart_items
+
+
 def add_product_to_cart(access_token, card_id, product_id, amount=1):
 
-    items = get_cart_items(access_token, card_id)
+    items = get_mirrored_cart_items(access_token, card_id)
     item = [item for item in items if item['product_id'] == product_id]
 
     if item:
@@ -105,7 +374,7 @@ def add_product_to_cart(access_token, card_id, product_id, amount=1):
 
 
 def add_item_to_cart(access_token, card_id, product_id, amount):
-    url = f'https://api.moltin.com/v2/carts/{card_id}/items'
+    url = f'{API_BASE_URL}/carts/{card_id}/items'
     headers = {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/json',
@@ -117,13 +386,13 @@ def add_item_to_cart(access_token, card_id, product_id, amount):
             'quantity': amount,
         }
     }
-    response = requests.post(url, headers=headers, json=params)
-    return response.json()
+    response = session.post(url, headers=headers, json=params)
+    return mirror_cart_response(card_id, response)
 
 
 def update_item_to_cart(access_token, card_id, product_id, item, amount):
 
-    url = f'https://api.moltin.com/v2/carts/{card_id}/items/{item["id"]}'
+    url = f'{API_BASE_URL}/carts/{card_id}/items/{item["id"]}'
     headers = {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/json',
@@ -135,46 +404,53 @@ def update_item_to_cart(access_token, card_id, product_id, item, amount):
             'quantity': item['quantity'] + amount,
         }
     }
-    response = requests.put(url, headers=headers, json=params)
-    return response.json()
+    response = session.put(url, headers=headers, json=params)
+    return mirror_cart_response(card_id, response)
 
 
 def delete_item_from_cart(access_token, card_id, item_id):
 
-    url = f'https://api.moltin.com/v2/carts/{card_id}/items/{item_id}'
+    url = f'{API_BASE_URL}/carts/{card_id}/items/{item_id}'
     headers = {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/json',
     }
-    response = requests.delete(url, headers=headers)
-    return response.json()
+    response = session.delete(url, headers=headers)
+    return mirror_cart_response(card_id, response)
 
 
 def get_cart_items(access_token, card_id):
 
-    url = f'https://api.moltin.com/v2/carts/{card_id}/items'
+    url = f'{API_BASE_URL}/carts/{card_id}/items'
     headers = {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/json',
     }
-    response = requests.get(url, headers=headers)
+    response = session.get(url, headers=headers)
     response.raise_for_status()
 
-    return response.json()['data']
+    items = response.json()['data']
+    cart_mirror.replace(card_id, items)
 
+    return items
 
-def get_customers(access_token):
-    url_api = 'https://api.moltin.com/v2/customers'
 
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json',
-    }
+def get_mirrored_cart_items(access_token, card_id):
+    items = cart_mirror.get_items(card_id)
+    if items is None:
+        items = get_cart_items(access_token, card_id)
 
-    response = requests.get(url_api, headers=headers)
-    response.raise_for_status()
+    return items
 
-    return response.json()['data']
+
+def iter_customers(access_token, page_size=DEFAULT_PAGE_SIZE, prefetch=False):
+    url_api = f'{API_BASE_URL}/customers'
+
+    return iter_pages(access_token, url_api, page_size=page_size, prefetch=prefetch)
+
+
+def get_customers(access_token):
+    return list(iter_customers(access_token, prefetch=True))
 
 
 def update_or_create_customer(access_token, customer):
@@ -186,7 +462,7 @@ def update_or_create_customer(access_token, customer):
 
 
 def fetch_customer_by_email(access_token, user_email):
-    url_api = 'https://api.moltin.com/v2/customers'
+    url_api = f'{API_BASE_URL}/customers'
 
     headers = {
         'Authorization': f'Bearer {access_token}',
@@ -196,14 +472,14 @@ def fetch_customer_by_email(access_token, user_email):
         'filter': f'eq(email,{user_email})'
     }
 
-    response = requests.get(url_api, headers=headers, params=params)
+    response = session.get(url_api, headers=headers, params=params)
     response.raise_for_status()
 
     return response.json()['data']
 
 
 def add_customer(access_token, customer):
-    url = f'https://api.moltin.com/v2/customers'
+    url = f'{API_BASE_URL}/customers'
     headers = {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/json',
@@ -215,14 +491,14 @@ def add_customer(access_token, customer):
     }
     params['data'].update(customer)
 
-    response = requests.post(url, headers=headers, json=params)
+    response = session.post(url, headers=headers, json=params)
     response.raise_for_status()
 
     return response.json()
 
 
 def update_customer(access_token, customer_id, customer):
-    url = f'https://api.moltin.com/v2/customers/{customer_id}'
+    url = f'{API_BASE_URL}/customers/{customer_id}'
     headers = {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/json',
@@ -234,14 +510,14 @@ def update_customer(access_token, customer_id, customer):
     }
     params['data'].update(customer)
 
-    response = requests.put(url, headers=headers, json=params)
+    response = session.put(url, headers=headers, json=params)
     response.raise_for_status()
 
     return response.json()
 
 
 def create_product(access_token, product):
-    url = 'https://api.moltin.com/v2/products'
+    url = f'{API_BASE_URL}/products'
     headers = {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/json',
@@ -266,16 +542,31 @@ def create_product(access_token, product):
         }
     }
 
-    response = requests.post(url, headers=headers, json=params)
+    response = session.post(url, headers=headers, json=params)
     response.raise_for_status()
 
-    product_id = response.json()['data']['id']
-    file_id = create_file(access_token, product['product_image']['url'])
-    main_image_relationship(access_token, product_id, file_id)
+    return response.json()['data']
+
+
+def find_product_by_sku(access_token, sku):
+    url = f'{API_BASE_URL}/products'
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+    }
+    params = {
+        'filter': f'eq(sku,{sku})'
+    }
+
+    response = session.get(url, headers=headers, params=params)
+    response.raise_for_status()
+
+    products = response.json()['data']
+
+    return products[0] if products else None
 
 
 def create_file(access_token, image_url):
-    url = 'https://api.moltin.com/v2/files'
+    url = f'{API_BASE_URL}/files'
     headers = {
         'Authorization': f'Bearer {access_token}',
     }
@@ -283,14 +574,14 @@ def create_file(access_token, image_url):
         'file_location': (None, image_url)
     }
 
-    response = requests.post(url, headers=headers, files=files)
+    response = session.post(url, headers=headers, files=files)
     response.raise_for_status()
 
     return response.json()['data']['id']
 
 
 def main_image_relationship(access_token, product_id, file_id):
-    url = f'https://api.moltin.com/v2/products/{product_id}/relationships/main-image'
+    url = f'{API_BASE_URL}/products/{product_id}/relationships/main-image'
     headers = {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/json',
@@ -302,45 +593,45 @@ def main_image_relationship(access_token, product_id, file_id):
         }
     }
 
-    response = requests.post(url, headers=headers, json=params)
+    response = session.post(url, headers=headers, json=params)
     response.raise_for_status()
 
     return response.json()
 
 
 def delete_product(access_token, product_id):
-    url = f'https://api.moltin.com/v2/products/{product_id}'
+    url = f'{API_BASE_URL}/products/{product_id}'
     headers = {
         'Authorization': f'Bearer {access_token}',
     }
-    response = requests.delete(url, headers=headers)
+    response = session.delete(url, headers=headers)
     response.raise_for_status()
 
     print(f'Deleted: {product_id}')
 
 
-def delete_files(access_token):
-    url = 'https://api.moltin.com/v2/files'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
+def iter_files(access_token, page_size=DEFAULT_PAGE_SIZE, prefetch=False):
+    url = f'{API_BASE_URL}/files'
+
+    return iter_pages(access_token, url, page_size=page_size, prefetch=prefetch)
+
 
-    files = response.json()['data']
+def delete_files(access_token):
+    # Удаление сдвигает смещения страниц, поэтому сначала собираем весь список
+    files = list(iter_files(access_token, prefetch=True))
     for file in files:
-        url = f'https://api.moltin.com/v2/files/{file["id"]}'
+        url = f'{API_BASE_URL}/files/{file["id"]}'
         headers = {
             'Authorization': f'Bearer {access_token}',
         }
-        response = requests.delete(url, headers=headers)
+        response = session.delete(url, headers=headers)
         response.raise_for_status()
 
         print(f'Deleted: {file["id"]}')
 
 
 def create_flow(access_token, flow, fields):
-    url = 'https://api.moltin.com/v2/flows'
+    url = f'{API_BASE_URL}/flows'
     flow_name, flow_slug, flow_description = flow
     headers = {
         'Authorization': f'Bearer {access_token}',
@@ -356,7 +647,7 @@ def create_flow(access_token, flow, fields):
         }
     }
 
-    response = requests.post(url, headers=headers, json=params)
+    response = session.post(url, headers=headers, json=params)
     response.raise_for_status()
 
     flow = response.json()['data']
@@ -368,32 +659,29 @@ def create_flow(access_token, flow, fields):
     return flow
 
 
-def fetch_flows(access_token):
-    url = 'https://api.moltin.com/v2/flows'
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json',
-    }
+def iter_flows(access_token, page_size=DEFAULT_PAGE_SIZE, prefetch=False):
+    url = f'{API_BASE_URL}/flows'
 
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
+    return iter_pages(access_token, url, page_size=page_size, prefetch=prefetch)
 
-    return response.json()['data']
+
+def fetch_flows(access_token):
+    return list(iter_flows(access_token, prefetch=True))
 
 
 def delete_flow(access_token, flow_id):
-    url = f'https://api.moltin.com/v2/flows/{flow_id}'
+    url = f'{API_BASE_URL}/flows/{flow_id}'
     headers = {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/json',
     }
 
-    response = requests.delete(url, headers=headers)
+    response = session.delete(url, headers=headers)
     response.raise_for_status()
 
 
 def create_fields(access_token, flow_id, field_name, filed_type):
-    url = 'https://api.moltin.com/v2/fields'
+    url = f'{API_BASE_URL}/fields'
     headers = {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/json',
@@ -417,14 +705,14 @@ def create_fields(access_token, flow_id, field_name, filed_type):
             }
         }
     }
-    response = requests.post(url, headers=headers, json=params)
+    response = session.post(url, headers=headers, json=params)
     response.raise_for_status()
 
     return response.json()['data']
 
 
 def create_entries(access_token, flow_slug, entry):
-    url = f'https://api.moltin.com/v2/flows/{flow_slug}/entries'
+    url = f'{API_BASE_URL}/flows/{flow_slug}/entries'
 
     headers = {
         'Authorization': f'Bearer {access_token}',
@@ -437,35 +725,35 @@ def create_entries(access_token, flow_slug, entry):
     }
     params['data'].update(entry)
 
-    response = requests.post(url, headers=headers, json=params)
+    response = session.post(url, headers=headers, json=params)
     response.raise_for_status()
 
     return response.json()['data']
 
 
-def fetch_entries(access_token, flow_slug):
-    url_api = f'https://api.moltin.com/v2/flows/{flow_slug}/entries'
+def iter_entries(access_token, flow_slug, page_size=DEFAULT_PAGE_SIZE, prefetch=False):
+    url_api = f'{API_BASE_URL}/flows/{flow_slug}/entries'
 
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json',
-    }
+    return iter_pages(access_token, url_api, page_size=page_size, prefetch=prefetch)
 
-    response = requests.get(url_api, headers=headers)
-    response.raise_for_status()
 
-    return response.json()['data']
+def fetch_entries(access_token, flow_slug):
+    return list(iter_entries(access_token, flow_slug, prefetch=True))
+
+
+def find_entry(access_token, flow_slug, field, value):
+    return next((entry for entry in iter_entries(access_token, flow_slug) if entry.get(field) == value), None)
 
 
 def get_entry(access_token, flow_slug, entry_id):
-    url_api = f'https://api.moltin.com/v2/flows/{flow_slug}/entries/{entry_id}'
+    url_api = f'{API_BASE_URL}/flows/{flow_slug}/entries/{entry_id}'
 
     headers = {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/json',
     }
 
-    response = requests.get(url_api, headers=headers)
+    response = session.get(url_api, headers=headers)
     response.raise_for_status()
 
     return response.json()['data']
@@ -475,6 +763,7 @@ if __name__ == '__main__':
 
     env = Env()
     env.read_env()
+    configure_session_from_env(env)
 
     client_id = env.str('MOTLIN_CLIENT_ID')
     client_secret = env.str('MOTLIN_CLIENT_SECRET')
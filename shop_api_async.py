@@ -0,0 +1,67 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import shop_api
+
+
+# Один пул потоков поверх общей сессии shop_api
+executor = ThreadPoolExecutor(max_workers=shop_api.DEFAULT_POOL_SIZE, thread_name_prefix='moltin-async')
+
+
+def configure_executor(max_workers=shop_api.DEFAULT_POOL_SIZE):
+    global executor
+
+    old_executor = executor
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='moltin-async')
+    old_executor.shutdown(wait=False)
+
+    return executor
+
+
+def make_async(func):
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+    return wrapper
+
+
+client_credentials_access_token = make_async(shop_api.client_credentials_access_token)
+fetch_products = make_async(shop_api.fetch_products)
+get_product_by_id = make_async(shop_api.get_product_by_id)
+take_product_image_description = make_async(shop_api.take_product_image_description)
+get_cart = make_async(shop_api.get_cart)
+get_cart_view = make_async(shop_api.get_cart_view)
+delete_cart = make_async(shop_api.delete_cart)
+add_product_to_cart = make_async(shop_api.add_product_to_cart)
+add_item_to_cart = make_async(shop_api.add_item_to_cart)
+update_item_to_cart = make_async(shop_api.update_item_to_cart)
+delete_item_from_cart = make_async(shop_api.delete_item_from_cart)
+get_cart_items = make_async(shop_api.get_cart_items)
+get_mirrored_cart_items = make_async(shop_api.get_mirrored_cart_items)
+get_customers = make_async(shop_api.get_customers)
+update_or_create_customer = make_async(shop_api.update_or_create_customer)
+fetch_customer_by_email = make_async(shop_api.fetch_customer_by_email)
+add_customer = make_async(shop_api.add_customer)
+update_customer = make_async(shop_api.update_customer)
+create_product = make_async(shop_api.create_product)
+create_file = make_async(shop_api.create_file)
+main_image_relationship = make_async(shop_api.main_image_relationship)
+delete_product = make_async(shop_api.delete_product)
+create_flow = make_async(shop_api.create_flow)
+fetch_flows = make_async(shop_api.fetch_flows)
+delete_flow = make_async(shop_api.delete_flow)
+create_fields = make_async(shop_api.create_fields)
+create_entries = make_async(shop_api.create_entries)
+fetch_entries = make_async(shop_api.fetch_entries)
+get_entry = make_async(shop_api.get_entry)
+
+
+def gather(*calls):
+    # Независимые вызовы выполняются параллельно в общем пуле
+    futures = [executor.submit(call) for call in calls]
+
+    return [future.result() for future in futures]
@@ -0,0 +1,269 @@
+import re
+import dbm
+import json
+import shelve
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from metrics import registry
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STATE_PATH = 'state.sqlite3'
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_MAX_CACHED = 10000
+LEGACY_SHELVE_PATH = 'state'
+
+FLUSH_SECONDS = registry.histogram('state_store_flush_duration_seconds', 'Время сброса изменений в SQLite', ['table'])
+FLUSHED_KEYS = registry.counter('state_store_flushed_keys_total', 'Записано ключей в SQLite', ['table'])
+
+
+class SQLiteBackend:
+    # Хранилище для StateStore: load, save, is_empty, close
+
+    def __init__(self, path=DEFAULT_STATE_PATH, table='state'):
+        if not re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', table):
+            raise ValueError(f'Некорректное имя таблицы: {table}')
+
+        self.path = path
+        self.table = table
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, value TEXT NOT NULL)'
+            )
+            self._connection = connection
+
+        return self._connection
+
+    def load(self, key):
+        with self._lock:
+            row = self._connect().execute(
+                f'SELECT value FROM {self.table} WHERE key = ?', (key,)
+            ).fetchone()
+
+        if row is None:
+            raise KeyError(key)
+
+        return json.loads(row[0])
+
+    def save(self, items):
+        rows = []
+        for key, value in items:
+            try:
+                rows.append((key, json.dumps(value, ensure_ascii=False)))
+            except (TypeError, ValueError) as err:
+                # Одно несериализуемое значение не должно останавливать сброс остальных
+                logger.error(f'Не удалось сохранить ключ {key} в {self.table}: {err}')
+        with self._lock:
+            connection = self._connect()
+            try:
+                connection.execute('BEGIN')
+                connection.executemany(
+                    f'INSERT INTO {self.table} (key, value) VALUES (?, ?) '
+                    'ON CONFLICT(key) DO UPDATE SET value = excluded.value',
+                    rows
+                )
+                connection.execute('COMMIT')
+            except sqlite3.Error:
+                if connection.in_transaction:
+                    connection.execute('ROLLBACK')
+                raise
+
+    def is_empty(self):
+        with self._lock:
+            row = self._connect().execute(f'SELECT 1 FROM {self.table} LIMIT 1').fetchone()
+
+        return row is None
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+class StateStore:
+    # Запись в память со сбросом в хранилище в фоне, чтение через LRU
+
+    def __init__(self, path=DEFAULT_STATE_PATH, table='state', flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 batch_size=DEFAULT_BATCH_SIZE, max_cached=DEFAULT_MAX_CACHED, backend=None):
+        self.backend = backend or SQLiteBackend(path, table)
+        self.table = table
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_cached = max_cached
+        self._cache = OrderedDict()
+        self._dirty = {}
+        self._flushing = {}
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def path(self):
+        return self.backend.path
+
+    @path.setter
+    def path(self, path):
+        self.backend.path = path
+
+    def _remember(self, key, value):
+        # Вызывается под self._lock
+        if self.max_cached <= 0:
+            return
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+
+    def _get_unsaved(self, key):
+        # Вызывается под self._lock
+        if key in self._dirty:
+            return True, self._dirty[key]
+        if key in self._flushing:
+            return True, self._flushing[key]
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return True, self._cache[key]
+
+        return False, None
+
+    def __getitem__(self, key):
+        key = str(key)
+        with self._lock:
+            found, value = self._get_unsaved(key)
+        if found:
+            return value
+
+        value = self.backend.load(key)
+        with self._lock:
+            # Пока читали, значение могли записать
+            found, newer = self._get_unsaved(key)
+            if found:
+                return newer
+            self._remember(key, value)
+
+        return value
+
+    def __setitem__(self, key, value):
+        key = str(key)
+        with self._lock:
+            self._cache.pop(key, None)
+            self._remember(key, value)
+            self._dirty[key] = value
+            pending = len(self._dirty)
+
+        if pending >= self.batch_size:
+            self.flush()
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return 0
+                batch, self._dirty = self._dirty, {}
+                # До записи в хранилище значения читаются отсюда
+                self._flushing = batch
+
+            try:
+                with FLUSH_SECONDS.time(table=self.table):
+                    self.backend.save(batch.items())
+            except Exception:
+                with self._lock:
+                    # Более свежие значения, записанные во время сброса, не перетираем
+                    self._dirty = {**batch, **self._dirty}
+                    self._flushing = {}
+                raise
+
+            with self._lock:
+                self._flushing = {}
+
+        FLUSHED_KEYS.inc(len(batch), table=self.table)
+
+        return len(batch)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as err:
+                logger.exception(f'Не удалось сохранить состояния в {self.path}: {err}')
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f'{self.table}-flush', daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        self.backend.close()
+
+    def is_empty(self):
+        with self._lock:
+            if self._cache or self._dirty:
+                return False
+
+        return self.backend.is_empty()
+
+
+def migrate_from_shelve(store, shelve_path=LEGACY_SHELVE_PATH):
+    if not dbm.whichdb(shelve_path):
+        return 0
+
+    with shelve.open(shelve_path, flag='r') as db:
+        migrated = 0
+        for key in db.keys():
+            if key not in store:
+                store[key] = db[key]
+                migrated += 1
+
+    store.flush()
+    logger.info(f'Перенесено состояний из {shelve_path}: {migrated}')
+
+    return migrated
+
+
+state_store = StateStore()
+
+
+def configure_state_store(path=DEFAULT_STATE_PATH, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                          max_cached=DEFAULT_MAX_CACHED):
+    state_store.path = path
+    state_store.flush_interval = flush_interval
+    state_store.max_cached = max_cached
+
+    if state_store.is_empty():
+        migrate_from_shelve(state_store)
+    state_store.start()
+
+    return state_store
@@ -0,0 +1,61 @@
+import time
+
+from telegram import Bot
+from telegram.error import TelegramError, RetryAfter
+from telegram.utils.request import Request
+
+from metrics import registry
+from telegram_scheduler import RETRY_AFTER, is_message_method
+
+
+DEFAULT_CON_POOL_SIZE = 8
+
+REQUEST_SECONDS = registry.histogram(
+    'telegram_request_duration_seconds', 'Время вызова метода Bot API', ['method']
+)
+REQUESTS = registry.counter('telegram_requests_total', 'Вызовы методов Bot API по результату', ['method', 'result'])
+
+
+class InstrumentedRequest(Request):
+    # Все вызовы Bot API проходят через post
+    __slots__ = ('scheduler',)
+
+    def __init__(self, *args, scheduler=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler
+
+    def _timed_post(self, method, url, data, timeout):
+        started_at = time.perf_counter()
+        try:
+            result = super().post(url, data, timeout=timeout)
+        except TelegramError as err:
+            REQUESTS.inc(method=method, result=type(err).__name__)
+            raise
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - started_at, method=method)
+
+        REQUESTS.inc(method=method, result='ok')
+
+        return result
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        chat_id = data.get('chat_id') if data else None
+        if self.scheduler is None or chat_id is None:
+            return self._timed_post(method, url, data, timeout)
+
+        attempt = 0
+        while True:
+            self.scheduler.acquire(chat_id, is_message=is_message_method(method))
+            try:
+                return self._timed_post(method, url, data, timeout)
+            except RetryAfter as err:
+                RETRY_AFTER.inc(method=method)
+                attempt += 1
+                if attempt > self.scheduler.max_retries:
+                    raise
+                self.scheduler.pause(chat_id, err.retry_after)
+
+
+def create_bot(token, con_pool_size=DEFAULT_CON_POOL_SIZE, scheduler=None):
+    return Bot(token, request=InstrumentedRequest(con_pool_size=con_pool_size, scheduler=scheduler))
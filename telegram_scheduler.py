@@ -0,0 +1,145 @@
+import time
+import heapq
+import threading
+from itertools import count
+from contextlib import contextmanager
+
+from metrics import registry
+from rate_limit import TokenBucket
+
+
+# Ограничения Bot API: всего, в личный чат и в группу
+DEFAULT_GLOBAL_RATE = 30
+DEFAULT_CHAT_RATE = 1
+DEFAULT_CHAT_BURST = 3
+DEFAULT_GROUP_RATE = 20 / 60
+DEFAULT_GROUP_BURST = 20
+DEFAULT_MAX_RETRIES = 3
+IDLE_BUCKET_TTL = 10 * 60
+# Правки и удаления не расходуют лимит чата
+MESSAGE_METHODS = ('forwardMessage', 'copyMessage')
+
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BULK: 'bulk'}
+
+WAITING = registry.gauge('telegram_outbound_waiting', 'Вызовы Bot API, ожидающие отправки', ['priority'])
+WAIT_SECONDS = registry.histogram(
+    'telegram_outbound_wait_seconds', 'Ожидание отправки из-за ограничений Bot API', ['priority']
+)
+RETRY_AFTER = registry.counter('telegram_retry_after_total', 'Ответы 429 от Bot API', ['method'])
+
+_local = threading.local()
+
+
+@contextmanager
+def outbound_priority(priority):
+    previous = getattr(_local, 'priority', INTERACTIVE)
+    _local.priority = priority
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def current_priority():
+    return getattr(_local, 'priority', INTERACTIVE)
+
+
+def is_group_chat(chat_id):
+    try:
+        return int(chat_id) < 0
+    except (TypeError, ValueError):
+        # @username канала
+        return True
+
+
+def is_message_method(method):
+    return (method.startswith('send') and method != 'sendChatAction') or method in MESSAGE_METHODS
+
+
+class OutboundScheduler:
+    # Вызов ждёт паузы чата после 429, новое сообщение - ещё и лимита чата
+
+    def __init__(self, global_rate=DEFAULT_GLOBAL_RATE, chat_rate=DEFAULT_CHAT_RATE, chat_burst=DEFAULT_CHAT_BURST,
+                 group_rate=DEFAULT_GROUP_RATE, group_burst=DEFAULT_GROUP_BURST, max_retries=DEFAULT_MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self._chat_buckets = {}
+        self._paused_until = {}
+        self._waiting = []
+        self._tickets = count()
+        self._lock = threading.Lock()
+        self._condition = threading.Condition()
+
+    def _get_chat_bucket(self, chat_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._chat_buckets.get(chat_id)
+            if entry is None:
+                if len(self._chat_buckets) > 1000:
+                    self._chat_buckets = {
+                        key: value for key, value in self._chat_buckets.items()
+                        if now - value[1] < IDLE_BUCKET_TTL
+                    }
+                if is_group_chat(chat_id):
+                    bucket = TokenBucket(self.group_rate, self.group_burst)
+                else:
+                    bucket = TokenBucket(self.chat_rate, self.chat_burst)
+                entry = (bucket, now)
+            self._chat_buckets[chat_id] = (entry[0], now)
+
+        return entry[0]
+
+    def _pause_delay(self, chat_id):
+        with self._lock:
+            paused_until = self._paused_until.get(chat_id, 0)
+
+        return paused_until - time.monotonic()
+
+    def pause(self, chat_id, seconds):
+        now = time.monotonic()
+        with self._lock:
+            self._paused_until = {key: until for key, until in self._paused_until.items() if until > now}
+            self._paused_until[chat_id] = max(self._paused_until.get(chat_id, 0), now + seconds)
+
+    def _wait_chat(self, chat_id, is_message):
+        while True:
+            delay = self._pause_delay(chat_id)
+            if delay > 0:
+                time.sleep(delay)
+                continue
+            if not is_message:
+                return
+            self._get_chat_bucket(chat_id).acquire()
+            # Пауза могла начаться, пока ждали токен
+            if self._pause_delay(chat_id) <= 0:
+                return
+
+    def _wait_global(self, priority):
+        ticket = (priority, next(self._tickets))
+        with self._condition:
+            heapq.heappush(self._waiting, ticket)
+            while True:
+                if self._waiting[0] == ticket and self.global_bucket.try_acquire():
+                    heapq.heappop(self._waiting)
+                    self._condition.notify_all()
+                    return
+                timeout = self.global_bucket.delay() if self._waiting[0] == ticket else None
+                self._condition.wait(timeout)
+
+    def acquire(self, chat_id, priority=None, is_message=True):
+        priority = current_priority() if priority is None else priority
+        labels = {'priority': PRIORITY_NAMES.get(priority, str(priority))}
+
+        WAITING.inc(**labels)
+        try:
+            with WAIT_SECONDS.time(**labels):
+                self._wait_chat(chat_id, is_message)
+                self._wait_global(priority)
+        finally:
+            WAITING.dec(**labels)
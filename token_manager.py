@@ -0,0 +1,70 @@
+import time
+import logging
+import threading
+
+from shop_api import client_credentials_access_token
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REFRESH_MARGIN = 120
+RETRY_DELAY = 5
+
+
+class TokenManager:
+    # Токен обновляется фоновым потоком до истечения срока
+
+    def __init__(self, client_id, client_secret, refresh_margin=DEFAULT_REFRESH_MARGIN):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_margin = refresh_margin
+        self._token = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _needs_refresh(self, margin):
+        return self._token is None or time.time() + margin >= self._token['expires']
+
+    def _get_refresh_margin(self):
+        # Запас не больше половины срока жизни токена
+        expires_in = self._token.get('expires_in') if self._token else None
+        return self.refresh_margin if expires_in is None else min(self.refresh_margin, expires_in / 2)
+
+    def refresh(self, margin=None):
+        margin = self._get_refresh_margin() if margin is None else margin
+        with self._lock:
+            # Токен мог обновить другой поток, пока мы ждали блокировку
+            if self._needs_refresh(margin):
+                self._token = client_credentials_access_token(self.client_id, self.client_secret)
+
+        return self._token
+
+    def get_access_token(self):
+        if self._needs_refresh(margin=0):
+            self.refresh(margin=0)
+
+        return self._token['access_token']
+
+    def _run(self):
+        while True:
+            wait = max(0, self._token['expires'] - self._get_refresh_margin() - time.time())
+            if self._stop.wait(wait):
+                return
+            try:
+                self.refresh()
+            except Exception as err:
+                logger.warning(f'Не удалось обновить токен интернет-магазина: {err}')
+                if self._stop.wait(RETRY_DELAY):
+                    return
+
+    def start(self):
+        self.refresh()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='token-manager', daemon=True)
+            self._thread.start()
+
+        return self
+
+    def stop(self):
+        self._stop.set()
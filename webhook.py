@@ -0,0 +1,188 @@
+import hmac
+import json
+import queue
+import signal
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LISTEN = '0.0.0.0'
+DEFAULT_PORT = 8443
+DEFAULT_PATH = '/telegram'
+DEFAULT_QUEUE_SIZE = 1000
+DEFAULT_WORKERS = 8
+RETRY_AFTER = 1
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def get_update_chat_id(update):
+    # Чат, к которому относится обновление; для нажатия кнопки — чат сообщения с кнопкой
+    for value in update.values():
+        if isinstance(value, dict):
+            chat = value.get('chat') or (value.get('message') or {}).get('chat')
+            if chat:
+                return chat.get('id')
+            sender = value.get('from')
+            if sender:
+                return sender.get('id')
+
+    return update.get('update_id')
+
+
+class WebhookServer:
+    # HTTP-приемник обновлений Telegram с очередью на каждый обработчик
+
+    def __init__(self, handle_update, listen=DEFAULT_LISTEN, port=DEFAULT_PORT, path=DEFAULT_PATH,
+                 queue_size=DEFAULT_QUEUE_SIZE, workers=DEFAULT_WORKERS, secret_token=None):
+        self.handle_update = handle_update
+        self.secret_token = secret_token
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.workers = workers
+        self.queues = [queue.Queue(maxsize=max(1, queue_size // workers)) for _ in range(workers)]
+        self.accepted = 0
+        self.rejected = 0
+        self.forbidden = 0
+        self.processed = 0
+        self.failed = 0
+        self._counters_lock = threading.Lock()
+        self._server = None
+        self._threads = []
+        self._stopping = threading.Event()
+
+    def _count(self, counter):
+        with self._counters_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _create_request_handler(self):
+        server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def _reply(self, status, headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length)
+
+                if self.path != server.path:
+                    self._reply(404)
+                    return
+
+                if server.secret_token is not None:
+                    received = self.headers.get(SECRET_TOKEN_HEADER, '')
+                    if not hmac.compare_digest(received.encode(), server.secret_token.encode()):
+                        server._count('forbidden')
+                        self._reply(403)
+                        return
+
+                try:
+                    update = json.loads(body)
+                except ValueError:
+                    self._reply(400)
+                    return
+
+                try:
+                    server.get_queue(update).put_nowait(update)
+                except queue.Full:
+                    server._count('rejected')
+                    self._reply(503, {'Retry-After': str(RETRY_AFTER)})
+                    return
+
+                server._count('accepted')
+                self._reply(200)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        return RequestHandler
+
+    def get_queue(self, update):
+        return self.queues[hash(get_update_chat_id(update)) % len(self.queues)]
+
+    def join(self):
+        for updates in self.queues:
+            updates.join()
+
+    def _work(self, updates):
+        while True:
+            update = updates.get()
+            if update is None:
+                updates.task_done()
+                return
+            try:
+                self.handle_update(update)
+                self._count('processed')
+            except Exception as err:
+                self._count('failed')
+                logger.exception(f'Ошибка обработки обновления: {err}')
+            finally:
+                updates.task_done()
+            # Метка остановки могла не поместиться в полную очередь
+            if self._stopping.is_set() and updates.empty():
+                return
+
+    def start(self):
+        self._server = ThreadingHTTPServer((self.listen, self.port), self._create_request_handler())
+        self._server.daemon_threads = True
+        # При port=0 система выбирает свободный порт
+        self.port = self._server.server_address[1]
+
+        for number, updates in enumerate(self.queues):
+            thread = threading.Thread(
+                target=self._work, args=(updates,), name=f'webhook-worker-{number}', daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+        thread = threading.Thread(target=self._server.serve_forever, name='webhook-server', daemon=True)
+        thread.start()
+        logger.info(f'Прием обновлений на {self.listen}:{self.port}{self.path}')
+
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+        # Дорабатываем уже принятые обновления и останавливаем обработчиков
+        self._stopping.set()
+        for updates in self.queues:
+            try:
+                updates.put_nowait(None)
+            except queue.Full:
+                pass
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def stats(self):
+        with self._counters_lock:
+            return {
+                'queued': sum(updates.qsize() for updates in self.queues),
+                'accepted': self.accepted,
+                'rejected': self.rejected,
+                'forbidden': self.forbidden,
+                'processed': self.processed,
+                'failed': self.failed,
+            }
+
+
+def wait_for_stop_signal():
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: stop.set())
+
+    stop.wait()
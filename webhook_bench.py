@@ -0,0 +1,113 @@
+import time
+import random
+import secrets
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from webhook import WebhookServer, SECRET_TOKEN_HEADER, DEFAULT_PATH, DEFAULT_QUEUE_SIZE, DEFAULT_WORKERS
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='''
+        Нагрузочная проверка приема обновлений через webhook без обращения к Telegram.
+        Без --url поднимает локальный приемник с обработчиком-заглушкой.
+        '''
+    )
+    parser.add_argument('--url', help='адрес работающего приемника, например http://127.0.0.1:8443/telegram')
+    parser.add_argument('--secret-token', help='секрет webhook работающего приемника (WEBHOOK_SECRET_TOKEN)')
+    parser.add_argument('-n', '--updates', type=int, default=1000, help='число отправляемых обновлений')
+    parser.add_argument('-c', '--clients', type=int, default=16, help='число параллельных отправителей')
+    parser.add_argument('--chats', type=int, default=100, help='число разных чатов в обновлениях')
+    parser.add_argument('--handler-ms', type=float, default=20, help='время работы обработчика-заглушки, мс')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='обработчиков в локальном приемнике')
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE, help='размер очереди приемника')
+
+    return parser
+
+
+def build_update(update_id, chat_id):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Bench'},
+            'text': '/start',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        },
+    }
+
+
+def percentile(values, share):
+    if not values:
+        return 0
+    values = sorted(values)
+
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def send_updates(url, count, clients, chats, secret_token=None):
+    local = threading.local()
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def send(update_id):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+
+        update = build_update(update_id, random.randint(1, chats))
+        started_at = time.perf_counter()
+        headers = {SECRET_TOKEN_HEADER: secret_token} if secret_token else {}
+        response = local.session.post(url, json=update, headers=headers)
+        elapsed = time.perf_counter() - started_at
+
+        with lock:
+            latencies.append(elapsed)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        list(executor.map(send, range(1, count + 1)))
+
+    return time.perf_counter() - started_at, latencies, statuses
+
+
+if __name__ == '__main__':
+    args = create_parser().parse_args()
+
+    server = None
+    url = args.url
+    secret_token = args.secret_token
+    if not url:
+        secret_token = secrets.token_urlsafe(32)
+        server = WebhookServer(
+            lambda update: time.sleep(args.handler_ms / 1000),
+            listen='127.0.0.1',
+            port=0,
+            queue_size=args.queue_size,
+            workers=args.workers,
+            secret_token=secret_token
+        ).start()
+        url = f'http://127.0.0.1:{server.port}{DEFAULT_PATH}'
+
+    elapsed, latencies, statuses = send_updates(url, args.updates, args.clients, args.chats, secret_token)
+
+    print(f'Отправлено {args.updates} обновлений за {elapsed:.2f} с: {args.updates / elapsed:.0f} в секунду')
+    print(
+        f'Время ответа приемника: p50 {percentile(latencies, 0.5) * 1000:.1f} мс, '
+        f'p95 {percentile(latencies, 0.95) * 1000:.1f} мс, p99 {percentile(latencies, 0.99) * 1000:.1f} мс'
+    )
+    print(f'Коды ответа: {statuses}')
+
+    if server is not None:
+        drain_started_at = time.perf_counter()
+        server.join()
+        print(f'Очередь обработана за {time.perf_counter() - drain_started_at:.2f} с после отправки')
+        print(f'Счетчики приемника: {server.stats()}')
+        server.stop()